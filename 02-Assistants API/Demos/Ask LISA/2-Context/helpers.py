@@ -1,3 +1,5 @@
+from metrics import increment_counter
+
 # Helper method for retrieving an existing assistant or creating a new one
 def get_or_create_assistant(client, name, instructions, tools=None, tool_resources=None):
     for assistant in client.beta.assistants.list():
@@ -13,3 +15,12 @@ def get_or_create_assistant(client, name, instructions, tools=None, tool_resourc
     )
 
     return assistant
+
+# Helper function for cancelling a run whose output is no longer needed
+def cancel_run(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        increment_counter('runs_cancelled')
+    except Exception as e:
+        # The run may have finished in the meantime
+        increment_counter('run_cancel_errors')
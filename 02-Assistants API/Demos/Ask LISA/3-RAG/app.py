@@ -1,6 +1,7 @@
 from openai import OpenAI
-from flask import Flask, render_template, request, stream_with_context, make_response
+from flask import Flask, render_template, request, stream_with_context, make_response, jsonify
 from helpers import *
+from metrics import get_metrics
 
 client = OpenAI()
 vector_store = get_or_create_vector_store('Electric Vehicles', client)
@@ -57,8 +58,25 @@ def ask_assistant():
         response.headers['X-Thread-ID'] = thread.id
         return response
 
-# Generator for streaming output
+# REST method for retrieving metrics
+@app.route('/metrics', methods=['get'])
+def metrics():
+    return jsonify(get_metrics())
+
+# Generator for streaming output. If the client disconnects before the run
+# is finished, the run is cancelled so it stops consuming tokens.
 def generate(client, thread_id, assistant_id):
     with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id) as stream:
-        for text in stream.text_deltas:
-            yield text
+        try:
+            for text in stream.text_deltas:
+                yield text
+
+        except GeneratorExit:
+            # The client disconnected before the response was complete
+            increment_counter('client_disconnects')
+            run = stream.current_run
+
+            if run is not None and run.status in ['queued', 'in_progress', 'requires_action']:
+                cancel_run(client, thread_id, run.id)
+
+            raise
@@ -1,6 +1,8 @@
 from openai import OpenAI
-from flask import Flask, render_template, request, stream_with_context, make_response
+from flask import Flask, render_template, request, stream_with_context, make_response, jsonify
 from helpers import *
+from metrics import get_metrics
+from tools import call_tools
 
 client = OpenAI()
 
@@ -54,7 +56,7 @@ def ask_assistant():
             # If text is starting to stream back, wrap the stream
             # in a generator and return the generator to the client
             if event.event == 'thread.message.created':
-                response = make_response(stream_with_context(generate(main_stream)))
+                response = make_response(stream_with_context(generate(main_stream, thread.id, event.data.run_id)))
                 response.headers['X-Thread-ID'] = thread.id
                 return response
 
@@ -63,24 +65,7 @@ def ask_assistant():
             # stream that's created, wrap it in a generator, and return the
             # generator to the client.
             if event.event == 'thread.run.requires_action':
-                tool_outputs = []
-
-                for tool_call in event.data.required_action.submit_tool_outputs.tool_calls:
-                    function_name = tool_call.function.name
-
-                    if function_name == 'get_current_weather':
-                        print('Calling get_current_weather()')
-                        location = json.loads(tool_call.function.arguments)['location']
-                        output = get_current_weather(location)
-                    else:
-                        raise Exception('Invalid function name')
-
-                    tool_output = {
-                        'tool_call_id': tool_call.id,
-                        'output': output
-                    }
-
-                    tool_outputs.append(tool_output)
+                tool_outputs = call_tools(event.data.required_action.submit_tool_outputs.tool_calls)
 
                 # Pass the tool output(s) to the Assistants API
                 tool_stream = client.beta.threads.runs.submit_tool_outputs(
@@ -91,7 +76,7 @@ def ask_assistant():
                 )
 
                 # Return the new stream to the client
-                response = make_response(stream_with_context(generate(tool_stream)))
+                response = make_response(stream_with_context(generate(tool_stream, thread.id, event.data.id)))
                 response.headers['X-Thread-ID'] = thread.id
                 return response
 
@@ -106,10 +91,35 @@ def ask_assistant():
         response.headers['X-Thread-ID'] = thread.id
         return response
 
-# Generator for streaming output
-def generate(stream):
-    for event in stream:
-        if event.event == 'thread.message.delta':
-            for content in event.data.delta.content or []:
-                if content.type == 'text' and content.text and content.text.value:
-                    yield content.text.value
+# REST method for retrieving metrics
+@app.route('/metrics', methods=['get'])
+def metrics():
+    return jsonify(get_metrics())
+
+# Generator for streaming output. If the client disconnects before the run
+# is finished, the run is cancelled so it stops consuming tokens.
+def generate(stream, thread_id, run_id):
+    run_finished = False
+
+    try:
+        for event in stream:
+            if event.event == 'thread.message.delta':
+                for content in event.data.delta.content or []:
+                    if content.type == 'text' and content.text and content.text.value:
+                        yield content.text.value
+
+            elif event.event in run_end_events:
+                run_finished = True
+
+    except GeneratorExit:
+        # The client disconnected before the response was complete
+        increment_counter('client_disconnects')
+
+        if not run_finished:
+            cancel_run(client, thread_id, run_id)
+
+        raise
+
+    finally:
+        # Close the connection to the Assistants API
+        stream.close()
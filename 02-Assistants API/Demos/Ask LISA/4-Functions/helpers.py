@@ -1,4 +1,8 @@
-import os, json, requests
+import os, json, re, time, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import increment_counter, record_timing
+from tools import register_tool
 
 # Helper method for retrieving an existing assistant or creating a new one
 def get_or_create_assistant(client, name, instructions, tools=None, tool_resources=None):
@@ -16,12 +20,76 @@ def get_or_create_assistant(client, name, instructions, tools=None, tool_resourc
 
     return assistant
 
+# Events that signal the end of a run
+run_end_events = [
+    'thread.run.completed', 'thread.run.incomplete', 'thread.run.failed',
+    'thread.run.cancelled', 'thread.run.expired'
+]
+
+# Helper function for cancelling a run whose output is no longer needed
+def cancel_run(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        increment_counter('runs_cancelled')
+    except Exception as e:
+        # The run may have finished in the meantime
+        increment_counter('run_cancel_errors')
+
+# Settings for weather lookups. Set OPENWEATHER_BASE_URL to use another server,
+# such as the stub in "Load Test/weather_server.py". Conditions for up to
+# WEATHER_CACHE_SIZE locations are cached for WEATHER_CACHE_TTL seconds since
+# they change slowly. Requests that fail are retried WEATHER_RETRIES times.
+OPENWEATHER_BASE_URL = os.environ.get('OPENWEATHER_BASE_URL', 'https://api.openweathermap.org')
+WEATHER_TIMEOUT = (3.05, 5)
+WEATHER_RETRIES = 1
+WEATHER_BACKOFF = 0.2
+WEATHER_CACHE_TTL = 600
+WEATHER_CACHE_SIZE = 1000
+
+# Longest a lookup can take if every attempt times out, including the delays
+# between retries, which double each time starting with the second retry.
+# The tool's timeout is a little longer so the session gives up first and
+# reports why.
+WEATHER_MAX_SECONDS = (WEATHER_RETRIES + 1) * sum(WEATHER_TIMEOUT) + sum(WEATHER_BACKOFF * 2 ** n for n in range(1, WEATHER_RETRIES))
+
+# Session for calling the weather API. Connections are kept alive and reused,
+# and requests that fail because the server is unavailable are retried.
+weather_session = requests.Session()
+retry = Retry(total=WEATHER_RETRIES, backoff_factor=WEATHER_BACKOFF, status_forcelist=[502, 503, 504], allowed_methods=['GET'])
+weather_session.mount('https://', HTTPAdapter(pool_maxsize=16, max_retries=retry))
+weather_session.mount('http://', HTTPAdapter(pool_maxsize=16, max_retries=retry))
+
+# Helper function for normalizing a location so "London, UK" and "london,uk"
+# share a cache entry
+def normalize_location(location):
+    return re.sub(r'\s*,\s*', ',', ' '.join(location.lower().split()))
+
 # Tool function
 def get_current_weather(location):
-    api_key = os.environ['OPENWEATHER_API_KEY']
-    url = f'https://api.openweathermap.org/data/2.5/weather?q={location}&appid={api_key}&units=imperial'
-    response = requests.get(url)
-    return json.dumps(response.json())
+    start = time.perf_counter()
+
+    try:
+        response = weather_session.get(
+            f'{OPENWEATHER_BASE_URL}/data/2.5/weather',
+            params={ 'q': location, 'appid': os.environ['OPENWEATHER_API_KEY'], 'units': 'imperial' },
+            timeout=WEATHER_TIMEOUT
+        )
+
+        body = response.json()
+
+        # Report failures as errors so they aren't cached
+        if response.status_code != 200:
+            return json.dumps({ 'error': body.get('message', f'HTTP {response.status_code}') })
+
+        return json.dumps(body)
+
+    except (requests.RequestException, ValueError) as e:
+        # Don't include the exception message, which may contain the API key
+        increment_counter('weather_errors')
+        return json.dumps({ 'error': f'The weather service could not be reached ({type(e).__name__})' })
+
+    finally:
+        record_timing('weather_request', time.perf_counter() - start)
 
 # Tool description
 weather_tool = {
@@ -44,3 +112,15 @@ weather_tool = {
         }
     }
 }
+
+# Outputs are cached by location and concurrent lookups for the same location
+# share a single request
+register_tool(
+    weather_tool,
+    get_current_weather,
+    cache_ttl=WEATHER_CACHE_TTL,
+    cache_key=normalize_location,
+    cache_size=WEATHER_CACHE_SIZE,
+    timeout=WEATHER_MAX_SECONDS + 2,
+    max_concurrency=8
+)
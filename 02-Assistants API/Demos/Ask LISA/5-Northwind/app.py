@@ -1,18 +1,21 @@
+import time
 from openai import OpenAI
-from flask import Flask, render_template, request, stream_with_context, make_response
+from flask import Flask, render_template, request, stream_with_context, make_response, jsonify
 from helpers import *
+from metrics import get_metrics, record_timing
+from tools import call_tools
 
 client = OpenAI()
 
 assistant = get_or_create_assistant(
     client,
-    'LISA-northwind',
+    get_assistant_name('LISA-northwind'),
     instructions='''
         You are a friendly assistant named LISA who can answer questions about Northwind.
         Assume that monetary amounts are in dollars. Round such amounts to the nearest dollar
         in your output, and use commas as separators for amounts greater than $999.
-        ''',
-    tools=[database_tool]
+        ''' + get_sql_instructions(),
+    tools=[get_database_tool()]
 )
 
 app = Flask(__name__)
@@ -25,6 +28,8 @@ def index():
 # REST method for invoking the Assistants API
 @app.route('/assistant', methods=['get'])
 def ask_assistant():
+    start = time.perf_counter()
+
     try:
         # If the request contains a thread ID, retrieve the thread.
         # Otherwise, create a new thread.
@@ -55,7 +60,7 @@ def ask_assistant():
             # If text is starting to stream back, wrap the stream
             # in a generator and return the generator to the client
             if event.event == 'thread.message.created':
-                response = make_response(stream_with_context(generate(main_stream)))
+                response = make_response(stream_with_context(generate(main_stream, thread.id, event.data.run_id, start)))
                 response.headers['X-Thread-ID'] = thread.id
                 return response
 
@@ -64,24 +69,7 @@ def ask_assistant():
             # stream that's created, wrap it in a generator, and return the
             # generator to the client.
             if event.event == 'thread.run.requires_action':
-                tool_outputs = []
-
-                for tool_call in event.data.required_action.submit_tool_outputs.tool_calls:
-                    function_name = tool_call.function.name
-
-                    if function_name == 'query_database':
-                        print('Calling query_database()')
-                        input = json.loads(tool_call.function.arguments)['input']
-                        output = query_database(input)
-                    else:
-                        raise Exception('Invalid function name')
-
-                    tool_output = {
-                        'tool_call_id': tool_call.id,
-                        'output': output
-                    }
-
-                    tool_outputs.append(tool_output)
+                tool_outputs = call_tools(event.data.required_action.submit_tool_outputs.tool_calls)
 
                 # Pass the tool output(s) to the Assistants API
                 tool_stream = client.beta.threads.runs.submit_tool_outputs(
@@ -92,7 +80,7 @@ def ask_assistant():
                 )
 
                 # Return the new stream to the client and include the thread ID
-                response = make_response(stream_with_context(generate(tool_stream)))
+                response = make_response(stream_with_context(generate(tool_stream, thread.id, event.data.id, start)))
                 response.headers['X-Thread-ID'] = thread.id
                 return response
 
@@ -107,10 +95,38 @@ def ask_assistant():
         response.headers['X-Thread-ID'] = thread.id
         return response
 
-# Generator for streaming output
-def generate(stream):
-    for event in stream:
-        if event.event == 'thread.message.delta':
-            for content in event.data.delta.content or []:
-                if content.type == 'text' and content.text and content.text.value:
-                    yield content.text.value
+# REST method for retrieving metrics
+@app.route('/metrics', methods=['get'])
+def metrics():
+    return jsonify(get_metrics())
+
+# Generator for streaming output. If the client disconnects before the run
+# is finished, the run is cancelled so it stops consuming tokens. The time
+# taken by complete responses is recorded separately for each SQL mode.
+def generate(stream, thread_id, run_id, start):
+    run_finished = False
+
+    try:
+        for event in stream:
+            if event.event == 'thread.message.delta':
+                for content in event.data.delta.content or []:
+                    if content.type == 'text' and content.text and content.text.value:
+                        yield content.text.value
+
+            elif event.event in run_end_events:
+                run_finished = True
+
+        record_timing(f'response_{SQL_MODE}', time.perf_counter() - start)
+
+    except GeneratorExit:
+        # The client disconnected before the response was complete
+        increment_counter('client_disconnects')
+
+        if not run_finished:
+            cancel_run(client, thread_id, run_id)
+
+        raise
+
+    finally:
+        # Close the connection to the Assistants API
+        stream.close()
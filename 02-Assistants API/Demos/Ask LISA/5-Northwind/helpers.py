@@ -1,5 +1,19 @@
-import json, sqlite3, re
+import os, json, re, time
 from openai import OpenAI
+from metrics import increment_counter, record_timing
+from tools import register_tool
+from database import QueryError, QUERY_TIMEOUT, POOL_SIZE, run_query, validate_sql, get_cached_translation, cache_translation, get_schema, link_schema, format_schema
+
+# Database targeted by the query_database tool
+DATABASE_PATH = 'data/northwind.db'
+
+# How the assistant queries the database. In "text2sql" mode, the assistant
+# passes questions to the query_database tool, which asks another model to
+# write the SQL. In "sql" mode, the assistant writes the SQL itself from the
+# schema in its instructions and passes it to the run_sql tool, which saves
+# a model round trip for each query. Set the SQL_MODE environment variable to
+# choose a mode.
+SQL_MODE = os.environ.get('SQL_MODE', 'text2sql')
 
 # Helper method for retrieving an existing assistant or creating a new one
 def get_or_create_assistant(client, name, instructions, tools=None, tool_resources=None):
@@ -17,12 +31,39 @@ def get_or_create_assistant(client, name, instructions, tools=None, tool_resourc
 
     return assistant
 
+# Events that signal the end of a run
+run_end_events = [
+    'thread.run.completed', 'thread.run.incomplete', 'thread.run.failed',
+    'thread.run.cancelled', 'thread.run.expired'
+]
+
+# Helper function for cancelling a run whose output is no longer needed
+def cancel_run(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        increment_counter('runs_cancelled')
+    except Exception as e:
+        # The run may have finished in the meantime
+        increment_counter('run_cancel_errors')
+
 # Tool function
 def query_database(input):
+    start = time.perf_counter()
     sql = text2sql(input)
+    record_timing('text2sql', time.perf_counter() - start)
+    return run_sql(sql)
+
+# Tool function for direct-SQL mode
+def run_sql(sql):
     print(sql) # Show the query in the host window
-    result = execute_sql(sql)
-    return json.dumps(result)
+
+    try:
+        result = execute_sql(sql)
+    except QueryError as e:
+        print(e)
+        return json.dumps({ 'error': str(e) })
+
+    return json.dumps(result, separators=(',', ':'), default=str)
 
 # Tool description
 database_tool = {
@@ -43,6 +84,12 @@ database_tool = {
             Products - Information about the products that Northwind sells
             Orders - Information about orders placed by Northwind customers
             OrderDetails - Information abour order details such as products and quantities
+
+            Results are returned as JSON containing the column names, up to
+            100 rows, and the total row count. If the query returned more
+            rows than that, "truncated" is true and "summary" contains the
+            minimum, maximum, and mean of each numeric column over all rows.
+            If the query can't be run, the result contains an "error" instead.
             ''',
         'parameters': {
             'type': 'object',
@@ -57,124 +104,93 @@ database_tool = {
     }
 }
 
+# Tool description for direct-SQL mode
+sql_tool = {
+    'type': 'function',
+    'function': {
+        'name': 'run_sql',
+        'description': '''
+            Runs a SQLite query against the Northwind database and returns the
+            results. Use only the tables and columns listed in your
+            instructions.
+
+            Results are returned as JSON containing the column names, up to
+            100 rows, and the total row count. If the query returned more
+            rows than that, "truncated" is true and "summary" contains the
+            minimum, maximum, and mean of each numeric column over all rows.
+            If the query can't be run, the result contains an "error" instead.
+            ''',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'sql': {
+                    'type': 'string',
+                    'description': 'A well-formed SQLite query'
+                },
+            },
+            'required': ['sql']
+        }
+    }
+}
+
+# Register the tools. Query results are cached by the database layer, which
+# knows when the data changes, so the tools don't cache their outputs.
+register_tool(database_tool, query_database, timeout=120, max_concurrency=8)
+register_tool(sql_tool, run_sql, timeout=QUERY_TIMEOUT + 5, max_concurrency=POOL_SIZE)
+
+# Helper function for getting the name of the assistant for the current SQL
+# mode. Assistants are looked up by name, and the assistant for direct-SQL
+# mode has different tools and instructions.
+def get_assistant_name(name):
+    return f'{name}-sql' if SQL_MODE == 'sql' else name
+
+# Helper function for getting the database tool for the current SQL mode
+def get_database_tool():
+    return sql_tool if SQL_MODE == 'sql' else database_tool
+
+# Helper function for getting the instructions that describe the database to
+# the assistant in direct-SQL mode
+def get_sql_instructions():
+    if SQL_MODE != 'sql':
+        return ''
+
+    schema = get_schema(DATABASE_PATH)
+
+    return f'''
+        To answer questions about the Northwind database, write a SQLite query and pass it
+        to the run_sql tool. Query only the tables and columns listed below.
+        Do not use SELECT *. Be specific about fields in SELECT statements.
+
+        {format_schema(schema, schema, schema_descriptions)}
+        '''
+
+# Helper function for describing the tables relevant to a question
+def get_relevant_schema(text):
+    schema = get_schema(DATABASE_PATH)
+    tables = link_schema(schema, text, schema_descriptions)
+    return format_schema(schema, tables, schema_descriptions)
+
 # Helper function for generating SQL queries
 def text2sql(text):
+    # Reuse the SQL generated for the same question if the schema hasn't changed
+    sql = get_cached_translation(DATABASE_PATH, text)
+
+    if sql is not None:
+        return sql
+
+    # Include only the tables that are relevant to the question
+    schema = get_relevant_schema(text)
+
     prompt = f'''
         Generate a well-formed SQLite query from the prompt below. Return
         the SQL only. Do not include a description or markdown characters, and
         do not use SELECT *. Be specific about fields in SELECT statements.
 
         PROMPT: {text}
-    
+
         The database targeted by the query contains the following tables:
 
-        CREATE TABLE [Categories]
-        (
-            [CategoryID] INTEGER PRIMARY KEY AUTOINCREMENT,
-            [CategoryName] TEXT,
-            [Description] TEXT
-        )
-
-        CREATE TABLE [Customers]
-        (
-            [CustomerID] TEXT,
-            [CompanyName] TEXT,
-            [ContactName] TEXT,
-            [ContactTitle] TEXT,
-            [Address] TEXT,
-            [City] TEXT,
-            [Region] TEXT,
-            [PostalCode] TEXT,
-            [Country] TEXT,
-            [Phone] TEXT,
-            [Fax] TEXT,
-            PRIMARY KEY (`CustomerID`)
-        )
-
-        CREATE TABLE [Employees]
-        (
-            [EmployeeID] INTEGER PRIMARY KEY AUTOINCREMENT,
-            [LastName] TEXT,
-            [FirstName] TEXT,
-            [Title] TEXT,
-            [TitleOfCourtesy] TEXT,
-            [BirthDate] DATE,
-            [HireDate] DATE,
-            [Address] TEXT,
-            [City] TEXT,
-            [Region] TEXT,
-            [PostalCode] TEXT,
-            [Country] TEXT,
-            [HomePhone] TEXT,
-            [Extension] TEXT,
-            [Notes] TEXT,
-            [ReportsTo] INTEGER,
-            FOREIGN KEY ([ReportsTo]) REFERENCES [Employees] ([EmployeeID]) 
-            ON DELETE NO ACTION ON UPDATE NO ACTION
-        )
-
-        CREATE TABLE [Shippers]
-        (
-            [ShipperID] INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-            [CompanyName] TEXT NOT NULL,
-            [Phone] TEXT
-        )
-
-        CREATE TABLE [Suppliers]
-        (
-            [SupplierID] INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-            [CompanyName] TEXT NOT NULL,
-            [ContactName] TEXT,
-            [ContactTitle] TEXT,
-            [Address] TEXT,
-            [City] TEXT,
-            [Region] TEXT,
-            [PostalCode] TEXT,
-            [Country] TEXT,
-            [Phone] TEXT,
-            [Fax] TEXT,
-            [HomePage] TEXT
-        )
-
-        CREATE TABLE [Products]
-        (
-            [ProductID] INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-            [ProductName] TEXT NOT NULL,
-            [SupplierID] INTEGER,
-            [CategoryID] INTEGER,
-            [QuantityPerUnit] TEXT,
-            [UnitPrice] NUMERIC DEFAULT 0,
-            [UnitsInStock] INTEGER DEFAULT 0,
-            [UnitsOnOrder] INTEGER DEFAULT 0,
-            [ReorderLevel] INTEGER DEFAULT 0,
-            [Discontinued] TEXT NOT NULL DEFAULT '0',
-            FOREIGN KEY ([CategoryID]) REFERENCES [Categories] ([CategoryID]),
-            FOREIGN KEY ([SupplierID]) REFERENCES [Suppliers] ([SupplierID])
-        )
-
-        CREATE TABLE Orders
-        (
-            [OrderID] INTEGER PRIMARY KEY AUTOINCREMENT,
-            [CustomerID] INTEGER,
-            [EmployeeID] INTEGER,
-            [OrderDate] DATETIME,
-            [ShipperID] INTEGER,
-            FOREIGN KEY (EmployeeID) REFERENCES Employees (EmployeeID),
-            FOREIGN KEY (CustomerID) REFERENCES Customers (CustomerID),
-            FOREIGN KEY (ShipperID) REFERENCES Shippers (ShipperID)
-        );
-
-        CREATE TABLE [Order Details]
-        (
-            [OrderID] INTEGER NOT NULL,
-            [ProductID] INTEGER NOT NULL,
-            [UnitPrice] NUMERIC NOT NULL DEFAULT 0,
-            [Quantity] INTEGER NOT NULL DEFAULT 1,
-            [Discount] REAL NOT NULL DEFAULT 0,
-            PRIMARY KEY ("OrderID", "ProductID"),
-            FOREIGN KEY ([OrderID]) REFERENCES [Orders] ([OrderID]),
-            FOREIGN KEY ([ProductID]) REFERENCES [Products] ([ProductID]) 
-        )
+        {schema}
         '''
 
     messages = [
@@ -189,22 +205,104 @@ def text2sql(text):
     ]
 
     client = OpenAI()
-    
+    sql = generate_sql(client, messages)
+
+    # Check the SQL locally and ask the model to fix it if it can't be run
+    error = validate_sql(DATABASE_PATH, sql)
+
+    if error is None:
+        increment_counter('text2sql_valid')
+    else:
+        sql, error = repair_sql(client, messages, sql, error)
+
+    # Only cache SQL that can be run
+    if error is None:
+        cache_translation(DATABASE_PATH, text, sql)
+
+    return sql
+
+# Helper function for asking the model for SQL and extracting the SQL from
+# the response, which may contain markdown code fences despite the prompt
+def generate_sql(client, messages):
     response = client.chat.completions.create(
         model='gpt-4o',
         messages=messages
     )
 
     sql = response.choices[0].message.content
+    match = re.search(r'```[\w]*\s*(.*?)```', sql, flags=re.DOTALL)
+
+    if match:
+        sql = match[1]
 
-    # Strip markdown characters from the SQL if present
-    pattern = r'^```[\w]*\n|\n```$'
-    return re.sub(pattern, '', sql, flags=re.MULTILINE)
+    return sql.strip().strip('`').strip()
+
+# Maximum number of times text2sql asks the model to fix SQL that can't be run
+MAX_SQL_REPAIRS = 2
+
+# Helper function for asking the model to fix SQL that failed validation. The
+# exact error is passed back along with the SQL. If a table isn't found, the
+# full schema is included since the table may have been left out of the
+# prompt. Returns the last SQL generated and its error, or None if it's valid.
+def repair_sql(client, messages, sql, error):
+    start = time.perf_counter()
+    messages = list(messages)
+
+    for attempt in range(MAX_SQL_REPAIRS):
+        increment_counter('text2sql_repair_attempts')
+        prompt = f'''
+            The query failed with the following error:
+
+            {error}
+
+            Return a corrected SQLite query. Return the SQL only.
+            '''
+
+        if 'no such table' in error:
+            schema = get_schema(DATABASE_PATH)
+            prompt += f'''
+            The database contains the following tables:
+
+            {format_schema(schema, schema, schema_descriptions)}
+            '''
+
+        messages += [
+            { 'role': 'assistant', 'content': sql },
+            { 'role': 'user', 'content': prompt }
+        ]
+
+        sql = generate_sql(client, messages)
+        error = validate_sql(DATABASE_PATH, sql)
+
+        if error is None:
+            break
+
+    increment_counter('text2sql_repaired' if error is None else 'text2sql_invalid')
+    record_timing('text2sql_repair', time.perf_counter() - start)
+    return sql, error
+
+# Descriptions of the tables and columns in the database. They're included in
+# the schema passed to text2sql and used to pick the tables relevant to each
+# question.
+schema_descriptions = {
+    'Categories': 'Product categories such as beverages, condiments, and seafood',
+    'Customers': 'Customers who purchase Northwind products',
+    'CustomerCustomerDemo': 'Demographic groups that customers belong to',
+    'CustomerDemographics': 'Demographic groups of customers',
+    'Employees': 'Employees of Northwind Traders, including sales representatives',
+    'EmployeeTerritories': 'Territories assigned to employees',
+    'Order Details': 'Line items of orders with products, quantities, unit prices, and discounts. Used to compute sales and revenue',
+    'Orders': 'Orders placed by customers, the employees who sold them, and the shippers who delivered them',
+    'Products': 'Products that Northwind sells, with prices and inventory levels',
+    'Regions': 'Regions that territories belong to',
+    'Shippers': 'Companies that ship Northwind products',
+    'Suppliers': 'Suppliers of Northwind products',
+    'Territories': 'Territories and the regions they belong to',
+    'Order Details.Discount': 'Fraction from 0 to 1',
+    'Orders.ShipVia': 'Shipper',
+    'Products.Discontinued': "'1' if the product is discontinued"
+}
 
 # Helper function for executing SQL queries
 def execute_sql(sql):
-    connection = sqlite3.connect('data/northwind.db')
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    rows = cursor.fetchall()
-    return rows
+    return run_query(DATABASE_PATH, sql)
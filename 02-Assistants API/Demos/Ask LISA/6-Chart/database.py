@@ -0,0 +1,793 @@
+import os, re, sys, json, math, sqlite3, threading, time, atexit, hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from urllib.request import pathname2url
+from metrics import increment_counter, record_timing
+
+# Settings for the read-only connection pool
+POOL_SIZE = 4
+POOL_TIMEOUT = 30
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 64 * 1024
+STATEMENT_CACHE_SIZE = 256
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Helper function for opening a read-only connection to a database
+def open_connection(path):
+    uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+
+    # Connections are shared by threads, but only one thread uses a connection
+    # at a time. cached_statements keeps compiled statements for reuse.
+    connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    connection.execute('PRAGMA query_only = ON')
+    connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    connection.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+
+    increment_counter('db_connections_opened')
+    return connection
+
+# Helper function for borrowing a connection from the pool for a database.
+# Connections are created on demand up to POOL_SIZE and reused after that.
+@contextmanager
+def get_connection(path):
+    start = time.perf_counter()
+
+    with pools_lock:
+        pool = pools.setdefault(path, { 'idle': LifoQueue(), 'size': 0 })
+
+    try:
+        connection = pool['idle'].get_nowait()
+        increment_counter('db_connections_reused')
+
+    except Empty:
+        with pools_lock:
+            create = pool['size'] < POOL_SIZE
+
+            if create:
+                pool['size'] += 1
+
+        if create:
+            try:
+                connection = open_connection(path)
+            except Exception:
+                with pools_lock:
+                    pool['size'] -= 1
+
+                raise
+        else:
+            # Wait for another thread to return a connection
+            try:
+                connection = pool['idle'].get(timeout=POOL_TIMEOUT)
+            except Empty:
+                increment_counter('db_pool_timeouts')
+                raise TimeoutError(f'No database connection available for {path}')
+
+            increment_counter('db_connections_reused')
+
+    record_timing('db_connection_wait', time.perf_counter() - start)
+
+    try:
+        yield connection
+    finally:
+        if connection.in_transaction:
+            connection.rollback()
+
+        pool['idle'].put(connection)
+
+# Helper function for closing the idle connections in every pool
+def close_connections():
+    with pools_lock:
+        for pool in pools.values():
+            while True:
+                try:
+                    connection = pool['idle'].get_nowait()
+                except Empty:
+                    break
+
+                connection.close()
+                pool['size'] -= 1
+                increment_counter('db_connections_closed')
+
+atexit.register(close_connections)
+
+# Settings for the in-memory cache of query results
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+
+result_cache = OrderedDict()
+result_cache_bytes = 0
+result_cache_lock = threading.Lock()
+
+# Helper function for getting the version of a database file. The version
+# changes whenever the file is written to.
+def get_database_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Helper function for canonicalizing SQL so queries that differ only in
+# whitespace or a trailing semicolon share a cache entry. Quoted strings
+# and identifiers are left as is.
+def canonicalize_sql(sql):
+    parts = re.split(r'(\'(?:[^\']|\'\')*\'|"(?:[^"]|"")*")', sql)
+    parts = [part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)]
+    return ''.join(parts).strip().rstrip(';').strip()
+
+# Helper function for determining whether a query's results can be cached.
+# Queries whose results change from one execution to the next can't be.
+def is_cacheable(sql):
+    return re.search(r"random\s*\(|'now'|current_(date|time|timestamp)", sql, flags=re.IGNORECASE) is None
+
+# Helper function for estimating the memory used by a query result
+def get_result_size(result):
+    rows = result['rows']
+    return 1024 + sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows)
+
+# Helper function for retrieving the cached result of a query. Returns None if
+# the query isn't cached or the database has changed since it was cached.
+def get_cached_result(key, version):
+    global result_cache_bytes
+
+    with result_cache_lock:
+        entry = result_cache.get(key)
+
+        if entry is None:
+            return None
+
+        if entry['version'] != version:
+            del result_cache[key]
+            result_cache_bytes -= entry['size']
+            return None
+
+        result_cache.move_to_end(key)
+        return entry['result']
+
+# Helper function for caching the result of a query and evicting the least
+# recently used results when the cache exceeds its size limit
+def cache_result(key, version, result):
+    global result_cache_bytes
+    size = get_result_size(result)
+
+    if size > RESULT_CACHE_MAX_ENTRY_BYTES:
+        return
+
+    with result_cache_lock:
+        entry = result_cache.pop(key, None)
+
+        if entry is not None:
+            result_cache_bytes -= entry['size']
+
+        result_cache[key] = { 'version': version, 'result': result, 'size': size }
+        result_cache_bytes += size
+
+        while result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+            _, entry = result_cache.popitem(last=False)
+            result_cache_bytes -= entry['size']
+
+schemas = {}
+
+# Helper function for reading a database's schema from sqlite_master. Returns a
+# dictionary that maps table names to lists of columns. Each column lists its
+# name, type, whether it's part of the primary key, and the table and column it
+# references, if any. The schema is reread only when the database file changes.
+def get_schema(path):
+    version = get_database_version(path)
+    cached = schemas.get(path)
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    schema = {}
+
+    with get_connection(path) as connection:
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        ).fetchall()
+
+        for (table,) in tables:
+            quoted = table.replace('"', '""')
+            references = {}
+
+            for row in connection.execute(f'PRAGMA foreign_key_list("{quoted}")'):
+                references[row[3]] = (row[2], row[4])
+
+            schema[table] = [
+                {
+                    'name': name,
+                    'type': type or 'TEXT',
+                    'primary_key': pk > 0,
+                    'references': references.get(name)
+                }
+                for _, name, type, _, _, pk in connection.execute(f'PRAGMA table_info("{quoted}")')
+            ]
+
+    schemas[path] = (version, schema)
+    return schema
+
+# Helper function for quoting a table or column name if necessary
+def quote_name(name):
+    return name if re.fullmatch(r'[A-Za-z_]\w*', name) else f'[{name}]'
+
+# Helper function for describing tables in a compact form, for example
+# "Products(ProductID INTEGER PK, CategoryID INTEGER -> Categories.CategoryID)".
+# Descriptions of tables and columns (keyed by "Table" and "Table.Column")
+# are included as comments. BLOB columns are omitted.
+def format_schema(schema, tables, descriptions={}):
+    lines = []
+
+    for table in tables:
+        columns = []
+
+        for column in schema[table]:
+            if column['type'].upper() == 'BLOB':
+                continue
+
+            text = f"{quote_name(column['name'])} {column['type']}"
+
+            if column['primary_key']:
+                text += ' PK'
+
+            if column['references'] is not None:
+                text += f" -> {quote_name(column['references'][0])}.{quote_name(column['references'][1])}"
+
+            description = descriptions.get(f"{table}.{column['name']}")
+
+            if description is not None:
+                text += f' /* {description} */'
+
+            columns.append(text)
+
+        line = f"{quote_name(table)}({', '.join(columns)})"
+
+        if table in descriptions:
+            line += f' -- {descriptions[table]}'
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+# Words ignored by schema linking
+stop_words = set('''
+    a about all an and any are as at be by did do does each for from had has have how i in
+    is it list me most my of on or per show than that the their them there these this those
+    to was were what when where which who whose why with
+    '''.split())
+
+# Helper function for splitting text into lowercase words for schema linking.
+# Names such as "OrderDate" are split into "order" and "date", and simple
+# plurals are reduced to their singular forms.
+def tokenize(text):
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', text)
+    words = []
+
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        if word in stop_words:
+            continue
+
+        if word.endswith('ies') and len(word) > 4:
+            word = word[:-3] + 'y'
+        elif word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+            word = word[:-1]
+
+        words.append(word)
+
+    return words
+
+# Helper function for building a lexical index of a schema. Each table is
+# represented by weighted words from its name, its columns, and descriptions.
+# Words in the table name weigh the most, but less so in compound names.
+def build_schema_index(schema, descriptions={}):
+    index = {}
+
+    for table, columns in schema.items():
+        weights = {}
+
+        def add(text, weight):
+            for word in tokenize(text):
+                weights[word] = max(weights.get(word, 0), weight)
+
+        add(table, 3 / max(1, len(set(tokenize(table)))))
+        add(descriptions.get(table, ''), 2)
+
+        for column in columns:
+            add(column['name'], 1)
+            add(descriptions.get(f"{table}.{column['name']}", ''), 1)
+
+        index[table] = weights
+
+    return index
+
+# Minimum score of the best table for schema linking to be trusted. Scores
+# below it come from matching only column names or descriptions, not a table.
+MIN_LINK_SCORE = 5
+
+# Helper function for choosing the tables relevant to a question. Tables are
+# scored by the words they share with the question, with words that appear
+# in many tables counting less and tables named in full counting more.
+# Tables that score at least a quarter as well as the best one are chosen.
+# Tables needed to join them are added, as are the tables they reference,
+# since questions often name things only by their values (for example, a
+# shipper's name) and those values live in referenced tables. If no table
+# matches well, or only one table matches, all the tables are returned.
+def link_schema(schema, question, descriptions={}, max_tables=5):
+    index = build_schema_index(schema, descriptions)
+    words = set(tokenize(question))
+    scores = {}
+
+    for table, weights in index.items():
+        score = 0
+
+        for word in words & weights.keys():
+            tables_with_word = sum(1 for other in index.values() if word in other)
+            score += weights[word] * math.log(1 + len(index) / tables_with_word)
+
+        if set(tokenize(table)) <= words:
+            score *= 1.5
+
+        if score > 0:
+            scores[table] = score
+
+    if len(scores) == 0 or max(scores.values()) < MIN_LINK_SCORE:
+        return list(schema.keys())
+
+    best = max(scores.values())
+    tables = [table for table in sorted(scores, key=scores.get, reverse=True) if scores[table] >= best / 4][:max_tables]
+
+    if len(tables) == 1:
+        return list(schema.keys())
+
+    # Add tables that connect pairs of chosen tables that don't reference each other
+    links = {
+        table: { column['references'][0] for column in columns if column['references'] is not None }
+        for table, columns in schema.items()
+    }
+
+    def connected(a, b):
+        return b in links.get(a, set()) or a in links.get(b, set())
+
+    for a in list(tables):
+        for b in list(tables):
+            if a < b and not connected(a, b):
+                for bridge in schema:
+                    if bridge not in tables and connected(a, bridge) and connected(bridge, b):
+                        tables.append(bridge)
+                        break
+
+    # Add the tables that the chosen tables reference
+    for table in list(tables):
+        for referenced in links[table]:
+            if referenced in schema and referenced not in tables:
+                tables.append(referenced)
+
+    # Keep the tables in the order in which they appear in the database
+    return [table for table in schema if table in tables]
+
+# Settings for shaping query results
+MAX_ROWS = 100
+
+# Helper function for making a value more compact. Floating-point numbers are
+# rounded to 15 significant digits, which removes noise such as the trailing
+# digits of 26.218500000000002 without changing any amount.
+def compact_value(value):
+    if isinstance(value, float):
+        return float(f'{value:.15g}')
+
+    if isinstance(value, bytes):
+        return f'<{len(value)} bytes>'
+
+    return value
+
+# Helper function for determining whether every value in a column of rows is
+# a number or NULL
+def is_numeric_column(rows, index):
+    values = [row[index] for row in rows if row[index] is not None]
+    return len(values) > 0 and all(isinstance(value, (int, float)) for value in values)
+
+# Helper function for computing the total row count of a query and the
+# minimum, maximum, and mean of the given columns in a single aggregate query,
+# so SQLite does the work rather than Python. The query is wrapped in a CTE
+# with numbered column names, so duplicate or unnamed columns can be used.
+def summarize_query(connection, sql, column_count, numeric):
+    names = ', '.join(f'c{i}' for i in range(column_count))
+    aggregates = ''.join(f', MIN(c{i}), MAX(c{i}), AVG(c{i})' for i in numeric)
+    query = sql.strip().rstrip(';')
+    return connection.execute(f'WITH result({names}) AS (\n{query}\n) SELECT COUNT(*){aggregates} FROM result').fetchone()
+
+# Helper function for making column names unique by numbering repeated names,
+# so "Total", "Total" becomes "Total", "Total_2"
+def get_unique_names(names):
+    unique, seen = [], set()
+
+    for name in names:
+        candidate, n = name, 1
+
+        while candidate in seen:
+            n += 1
+            candidate = f'{name}_{n}'
+
+        unique.append(candidate)
+        seen.add(candidate)
+
+    return unique
+
+# Helper function for running a query and shaping its result. Only the first
+# max_rows rows are read and returned along with the column names and the
+# total number of rows. If there are more rows than that, the result is marked
+# as truncated and includes the minimum, maximum, and mean of each numeric
+# column over all the rows, which are computed by summarize_query. The
+# summary is keyed by column names made unique with get_unique_names. If the
+# summary can't be computed, for example because the query timed out, it's
+# left out and the row count is None.
+def shape_result(connection, sql, max_rows=MAX_ROWS):
+    cursor = connection.execute(sql)
+    columns = [description[0] for description in cursor.description or []]
+    rows = cursor.fetchmany(max_rows + 1)
+    result = { 'columns': columns, 'rows': [[compact_value(value) for value in row] for row in rows[:max_rows]], 'row_count': len(rows) }
+
+    if len(rows) <= max_rows:
+        return result
+
+    cursor.close()
+    result['truncated'] = True
+    increment_counter('sql_results_truncated')
+
+    # Treat a column as numeric if the rows that were read suggest it is
+    numeric = [i for i in range(len(columns)) if is_numeric_column(rows, i)]
+
+    try:
+        summary = summarize_query(connection, sql, len(columns), numeric)
+    except (sqlite3.Error, sqlite3.Warning):
+        increment_counter('sql_summaries_failed')
+        result['row_count'] = None
+        return result
+
+    result['row_count'] = summary[0]
+    names = get_unique_names(columns)
+
+    result['summary'] = {
+        names[i]: {
+            'min': compact_value(summary[1 + 3 * n]),
+            'max': compact_value(summary[2 + 3 * n]),
+            'mean': compact_value(summary[3 + 3 * n])
+        }
+        for n, i in enumerate(numeric) if summary[3 + 3 * n] is not None
+    }
+
+    return result
+
+# Settings for the query guardrails. Queries whose plans are estimated to
+# examine more than MAX_ESTIMATED_ROWS rows are rejected, as are queries that
+# join tables without a usable join condition if the tables have more than
+# MAX_CROSS_JOIN_ROWS combinations of rows. Queries that run longer than
+# QUERY_TIMEOUT seconds are interrupted.
+MAX_ESTIMATED_ROWS = 5000000
+MAX_CROSS_JOIN_ROWS = 100000
+QUERY_TIMEOUT = 10
+PROGRESS_INTERVAL = 10000
+
+table_sizes = {}
+
+# Exception raised when a query is rejected, times out, or fails
+class QueryError(Exception):
+    pass
+
+# Helper function for counting the rows in each table of a database. The
+# counts are refreshed only when the database file changes.
+def get_table_sizes(path):
+    version = get_database_version(path)
+    cached = table_sizes.get(path)
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    sizes = {}
+
+    with get_connection(path) as connection:
+        for table in get_schema(path):
+            quoted = table.replace('"', '""')
+            sizes[table] = connection.execute(f'SELECT COUNT(*) FROM "{quoted}"').fetchone()[0]
+
+    table_sizes[path] = (version, sizes)
+    return sizes
+
+# Helper function for mapping the names and aliases that a query uses for
+# tables (for example, "o" in "FROM Orders o") to the tables' names
+def get_table_aliases(sql, tables):
+    aliases = { table.lower(): table for table in tables }
+    name = r'"(?:[^"]|"")+"|\[[^\]]+\]|`[^`]+`|\w+'
+
+    for match in re.finditer(rf'(?:\bFROM|\bJOIN|,)\s*({name})(?:\s+(?:AS\s+)?({name}))?', sql, flags=re.IGNORECASE):
+        table, alias = [part.strip('"[]`').lower() if part else None for part in match.groups()]
+
+        if table in aliases and alias is not None and alias not in aliases:
+            aliases[alias] = aliases[table]
+
+    return aliases
+
+# Helper function for estimating the number of rows a query plan examines.
+# Tables that are scanned in full at the same level of the plan are joined in
+# nested loops, so their sizes are multiplied. Index lookups are assumed to be
+# cheap. Correlated subqueries run once per outer row.
+def estimate_plan_rows(plan, sizes, aliases, parent=0):
+    scanned = 1
+    correlated = 1
+    subqueries = 0
+
+    for id, parent_id, _, detail in plan:
+        if parent_id != parent:
+            continue
+
+        match = re.fullmatch(r'SCAN (?:TABLE )?(.+?)(?: AS \S+)?(?: USING (?:COVERING )?INDEX .+)?', detail)
+
+        if match:
+            scanned *= sizes.get(aliases.get(match[1].lower()), 1)
+        elif detail.startswith('CORRELATED'):
+            correlated = max(correlated, estimate_plan_rows(plan, sizes, aliases, id))
+        else:
+            subqueries = max(subqueries, estimate_plan_rows(plan, sizes, aliases, id))
+
+    return max(scanned * correlated, subqueries)
+
+# Helper function for estimating the number of rows examined by the largest
+# cross join in a query plan. Tables that are scanned in full at the same
+# level of the plan are joined without a usable join condition, since SQLite
+# looks up rows with an index or an automatic index when there is one.
+# Returns 0 if no tables are cross joined.
+def estimate_cross_join_rows(plan, sizes, aliases):
+    scans = {}
+
+    for _, parent_id, _, detail in plan:
+        match = re.fullmatch(r'SCAN (?:TABLE )?(.+?)(?: AS \S+)?(?: USING (?:COVERING )?INDEX .+)?', detail)
+
+        if match:
+            scans.setdefault(parent_id, []).append(sizes.get(aliases.get(match[1].lower()), 1))
+
+    return max([math.prod(tables) for tables in scans.values() if len(tables) > 1], default=0)
+
+# Helper function for rejecting a query whose plan would examine too many rows,
+# which usually means that tables are joined without a join condition
+def check_query_plan(connection, sql, sizes):
+    plan = connection.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+    aliases = get_table_aliases(sql, sizes)
+    rows = estimate_plan_rows(plan, sizes, aliases)
+    cross_join_rows = estimate_cross_join_rows(plan, sizes, aliases)
+
+    if cross_join_rows > MAX_CROSS_JOIN_ROWS:
+        increment_counter('sql_queries_rejected')
+
+        raise QueryError(
+            f'The query was not run because it joins tables without a join condition, so it would examine about '
+            f'{cross_join_rows:,} rows. Join the tables on their related columns, for example with JOIN ... ON.'
+        )
+
+    if rows > MAX_ESTIMATED_ROWS:
+        increment_counter('sql_queries_rejected')
+
+        raise QueryError(
+            f'The query was not run because it would examine about {rows:,} rows. '
+            'Make sure every joined table has a join condition and filter or aggregate the results.'
+        )
+
+# Helper function for checking a query without running it. The query is
+# compiled against the live schema and its plan is checked with
+# check_query_plan. Returns None if the query can be run, or the error that
+# SQLite or the plan check reported if it can't.
+def validate_sql(path, sql):
+    sizes = get_table_sizes(path)
+
+    with get_connection(path) as connection:
+        try:
+            check_query_plan(connection, sql, sizes)
+        except QueryError as e:
+            return str(e)
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            return str(e)
+
+    return None
+
+# Settings for the workload log, which records each query that's run,
+# including queries served from the result cache, and how long it took.
+# index_advisor.py uses the log to recommend indexes. When the log grows past
+# WORKLOAD_LOG_MAX_BYTES, it's renamed with a ".1" suffix, replacing the
+# previous one, so at most twice that much is kept. Set WORKLOAD_LOG_PATH to
+# None to turn the log off.
+WORKLOAD_LOG_PATH = 'sql_workload.jsonl'
+WORKLOAD_LOG_MAX_BYTES = 10 * 2**20
+
+workload_log_lock = threading.Lock()
+
+# Helper function for appending a query to the workload log
+def log_query(path, sql, seconds, row_count=None, error=None, cached=False):
+    if WORKLOAD_LOG_PATH is None:
+        return
+
+    entry = {
+        'time': round(time.time(), 3),
+        'database': os.path.abspath(path),
+        'sql': sql,
+        'seconds': round(seconds, 6),
+        'rows': row_count
+    }
+
+    if error is not None:
+        entry['error'] = error
+
+    if cached:
+        entry['cached'] = True
+
+    try:
+        with workload_log_lock:
+            with open(WORKLOAD_LOG_PATH, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry) + '\n')
+                size = file.tell()
+
+            if size > WORKLOAD_LOG_MAX_BYTES:
+                os.replace(WORKLOAD_LOG_PATH, WORKLOAD_LOG_PATH + '.1')
+    except OSError:
+        increment_counter('workload_log_errors')
+
+# Helper function for executing a query and returning the result shaped by
+# shape_result. Results are served from the cache if the same query was
+# executed before and the database hasn't changed since. Queries are checked
+# with check_query_plan before they run, and are interrupted if they exceed
+# QUERY_TIMEOUT. Errors are raised as QueryErrors. Every query, whether it's
+# executed or served from the cache, is recorded in the workload log.
+def run_query(path, sql, max_rows=MAX_ROWS):
+    start = time.perf_counter()
+    cacheable = is_cacheable(sql)
+
+    if cacheable:
+        key = (os.path.abspath(path), canonicalize_sql(sql), max_rows)
+        version = get_database_version(path)
+        result = get_cached_result(key, version)
+
+        if result is not None:
+            increment_counter('sql_result_cache_hits')
+            seconds = time.perf_counter() - start
+            log_query(path, sql, seconds, result['row_count'], cached=True)
+            record_timing('sql_execute', seconds)
+            return result
+
+        increment_counter('sql_result_cache_misses')
+
+    sizes = get_table_sizes(path)
+    deadline = start + QUERY_TIMEOUT
+
+    with get_connection(path) as connection:
+        connection.set_progress_handler(lambda: time.perf_counter() > deadline, PROGRESS_INTERVAL)
+
+        try:
+            check_query_plan(connection, sql, sizes)
+            result = shape_result(connection, sql, max_rows)
+
+        except QueryError:
+            log_query(path, sql, time.perf_counter() - start, error='rejected')
+            raise
+
+        except sqlite3.Error as e:
+            if time.perf_counter() > deadline:
+                increment_counter('sql_queries_timed_out')
+                log_query(path, sql, time.perf_counter() - start, error='timeout')
+                raise QueryError(f'The query was stopped because it ran longer than {QUERY_TIMEOUT} seconds.') from e
+
+            increment_counter('sql_errors')
+            log_query(path, sql, time.perf_counter() - start, error=str(e))
+            raise QueryError(str(e)) from e
+
+        finally:
+            connection.set_progress_handler(None, PROGRESS_INTERVAL)
+
+    seconds = time.perf_counter() - start
+    log_query(path, sql, seconds, result['row_count'])
+
+    if cacheable:
+        cache_result(key, version, result)
+
+    record_timing('sql_execute', seconds)
+    return result
+
+# Settings for the persistent cache of SQL generated by text2sql
+TRANSLATION_CACHE_PATH = 'text2sql_cache.db'
+TRANSLATION_CACHE_SIZE = 1000
+
+schema_fingerprints = {}
+translation_cache = None
+translation_cache_lock = threading.Lock()
+
+# Helper function for computing a fingerprint of a database's schema. The
+# fingerprint is recomputed only when the database file changes.
+def get_schema_fingerprint(path):
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = schema_fingerprints.get(path)
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with get_connection(path) as connection:
+        rows = connection.execute('SELECT type, name, sql FROM sqlite_master ORDER BY type, name').fetchall()
+
+    fingerprint = hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()
+    schema_fingerprints[path] = (version, fingerprint)
+    return fingerprint
+
+# Helper function for normalizing a question so trivially different
+# phrasings ("Total sales by category?" and "total  sales by category")
+# share a cache entry
+def normalize_question(question):
+    question = ' '.join(question.lower().split())
+    return question.strip(' .?!;:\'"')
+
+# Helper function for opening the translation cache
+def open_translation_cache():
+    global translation_cache
+
+    if translation_cache is None:
+        translation_cache = sqlite3.connect(TRANSLATION_CACHE_PATH, check_same_thread=False)
+
+        translation_cache.execute('''
+            CREATE TABLE IF NOT EXISTS Translations (
+                Key TEXT PRIMARY KEY,
+                Database TEXT NOT NULL,
+                Fingerprint TEXT NOT NULL,
+                Question TEXT NOT NULL,
+                Sql TEXT NOT NULL,
+                LastUsed REAL NOT NULL
+            )
+            ''')
+
+        translation_cache.commit()
+
+    return translation_cache
+
+# Helper function for computing the cache key for a question
+def get_translation_key(path, fingerprint, question):
+    key = f'{os.path.abspath(path)}|{fingerprint}|{normalize_question(question)}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# Helper function for retrieving cached SQL for a question. Returns None if
+# the question hasn't been translated against the current schema.
+def get_cached_translation(path, question):
+    fingerprint = get_schema_fingerprint(path)
+    key = get_translation_key(path, fingerprint, question)
+
+    with translation_cache_lock:
+        cache = open_translation_cache()
+        row = cache.execute('SELECT Sql FROM Translations WHERE Key = ?', (key,)).fetchone()
+
+        if row is None:
+            increment_counter('text2sql_cache_misses')
+            return None
+
+        cache.execute('UPDATE Translations SET LastUsed = ? WHERE Key = ?', (time.time(), key))
+        cache.commit()
+
+    increment_counter('text2sql_cache_hits')
+    return row[0]
+
+# Helper function for caching the SQL generated for a question. Entries for
+# older versions of the schema are removed, and the least recently used
+# entries are evicted when the cache is full.
+def cache_translation(path, question, sql):
+    fingerprint = get_schema_fingerprint(path)
+    key = get_translation_key(path, fingerprint, question)
+    database = os.path.abspath(path)
+
+    with translation_cache_lock:
+        cache = open_translation_cache()
+
+        cache.execute('DELETE FROM Translations WHERE Database = ? AND Fingerprint != ?', (database, fingerprint))
+
+        cache.execute(
+            'INSERT OR REPLACE INTO Translations VALUES (?, ?, ?, ?, ?, ?)',
+            (key, database, fingerprint, normalize_question(question), sql, time.time())
+        )
+
+        cache.execute(
+            'DELETE FROM Translations WHERE Key IN (SELECT Key FROM Translations ORDER BY LastUsed DESC LIMIT -1 OFFSET ?)',
+            (TRANSLATION_CACHE_SIZE,)
+        )
+
+        cache.commit()
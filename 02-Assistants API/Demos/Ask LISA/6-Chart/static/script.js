@@ -50,9 +50,13 @@ const streamChatResponse = async (incomingChatDiv) => {
         // Save the thread ID for subsequent requests
         threadID = response.headers.get("X-Thread-ID");
 
-        // Display the streaming response
+        // Display the streaming response. The response is a series of
+        // JSON events separated by newlines, and a network chunk can hold
+        // any number of events, including partial ones.
         var reader = response.body.getReader();
         var decoder = new TextDecoder("utf-8");
+        var buffer = "";
+        var statusElement = null;
 
         while (true) {
             var animation = incomingChatDiv.querySelector(".typing-animation")
@@ -63,27 +67,50 @@ const streamChatResponse = async (incomingChatDiv) => {
             if (done)
                 break;
 
-            var chunk = decoder.decode(value, { stream: true });
-
-            // If the chunk contains an image ID, download and display
-            // the image. Otherwise, append the latest chunk of text to
-            // the output.
-            if (chunk.startsWith("[[[IMAGEID]]]")) {
-                var file_id = chunk.slice(13);
-                var url = `/image?id=${file_id}`
-                var response = await fetch(url);
-                var imgElement = document.createElement("img");
-                imgElement.src = await response.text();
-                imgElement.setAttribute("class", "chart");
-                imgElement.setAttribute("alt", "llm-generated chart")
-                pElement.parentNode.parentNode.appendChild(imgElement); // Add image to chat-container DIV
-            }
-            else {
-                pElement.textContent += chunk;
+            buffer += decoder.decode(value, { stream: true });
+            var lines = buffer.split("\n");
+            buffer = lines.pop(); // Keep the partial event, if any, for the next read
+
+            for (const line of lines) {
+                if (line.length == 0)
+                    continue;
+
+                var event = JSON.parse(line);
+
+                if (event.type == "text") {
+                    // Append the latest chunk of text to the output
+                    pElement.textContent += event.text;
+                }
+                else if (event.type == "image") {
+                    // Display the image. The browser downloads it in parallel
+                    // while the rest of the response continues to stream.
+                    var imgElement = document.createElement("img");
+                    imgElement.src = `/image?id=${encodeURIComponent(event.id)}`;
+                    imgElement.setAttribute("class", "chart");
+                    imgElement.setAttribute("alt", "llm-generated chart")
+                    pElement.parentNode.parentNode.appendChild(imgElement); // Add image to chat-container DIV
+                }
+                else if (event.type == "tool") {
+                    // Show which tool is running, and remove the status when it's done
+                    if (statusElement != null)
+                        statusElement.remove();
+
+                    statusElement = null;
+
+                    if (event.status == "running") {
+                        statusElement = document.createElement("p");
+                        statusElement.setAttribute("class", "tool-status");
+                        statusElement.textContent = `Running ${event.name}...`;
+                        pElement.parentNode.parentNode.appendChild(statusElement); // Add status to chat-container DIV
+                    }
+                }
             }
 
             chatContainer.scrollTo(0, chatContainer.scrollHeight);
         }
+
+        if (statusElement != null)
+            statusElement.remove();
     }
     catch(error) {
         var animation = incomingChatDiv.querySelector(".typing-animation")
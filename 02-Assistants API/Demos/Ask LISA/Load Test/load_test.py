@@ -0,0 +1,109 @@
+# Load-test driver for the Ask LISA apps. Sends questions to an app's /assistant
+# endpoint at increasing levels of concurrency and reports time to first byte
+# (TTFB), tokens per second, and error rate at each level. Works with apps that
+# stream plain text and with apps that stream newline-delimited JSON events.
+#
+#   python load_test.py --url http://localhost:5000 --levels 1,2,4,8,16 --requests 32
+#
+# Use --vary to make every question unique, for example to compare the SQL
+# modes without cached translations hiding the cost of text2sql.
+
+import argparse, json, statistics, time, requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Responses the apps return in place of an answer when something goes wrong
+error_messages = [
+    "I'm sorry, but something went wrong",
+    'Oops! Can you try that again?',
+    "Give me a moment. I'm still working on your previous request"
+]
+
+# Helper function for sending a question and timing the response
+def ask(url, question, timeout):
+    start = time.perf_counter()
+    ttfb = None
+    body = b''
+
+    try:
+        response = requests.get(f'{url}/assistant', params={ 'input': question }, stream=True, timeout=timeout)
+
+        for chunk in response.iter_content(chunk_size=None):
+            if chunk and ttfb is None:
+                ttfb = time.perf_counter() - start
+
+            body += chunk
+
+        elapsed = time.perf_counter() - start
+        text = body.decode('utf-8')
+
+        # Extract the text from newline-delimited JSON events
+        if response.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+            events = [json.loads(line) for line in text.splitlines() if line]
+            text = ''.join(event['text'] for event in events if event['type'] == 'text')
+
+        ok = response.status_code == 200 and len(text) > 0 and not any(message in text for message in error_messages)
+
+        # Estimate the number of tokens as one per four characters
+        tokens = len(text) / 4
+        streaming_time = elapsed - (ttfb or elapsed)
+        tokens_per_second = tokens / streaming_time if streaming_time > 0 else None
+
+        return { 'ok': ok, 'ttfb': ttfb, 'elapsed': elapsed, 'tokens_per_second': tokens_per_second }
+
+    # Count failed requests and malformed responses, such as an error page in
+    # place of newline-delimited JSON, as errors
+    except (requests.RequestException, ValueError, KeyError):
+        return { 'ok': False, 'ttfb': None, 'elapsed': time.perf_counter() - start, 'tokens_per_second': None }
+
+# Helper function for computing a percentile
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+# Run the requests at one level of concurrency and summarize the results. If
+# vary is True, a request number is appended to each question so the apps'
+# caches can't answer repeated questions.
+def run_level(url, question, concurrency, count, timeout, vary=False):
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: ask(url, f'{question} ({concurrency}-{i + 1})' if vary else question, timeout), range(count)))
+
+    elapsed = time.perf_counter() - start
+    ttfbs = [result['ttfb'] for result in results if result['ok']]
+    rates = [result['tokens_per_second'] for result in results if result['ok'] and result['tokens_per_second']]
+    errors = sum(1 for result in results if not result['ok'])
+
+    return {
+        'concurrency': concurrency,
+        'requests': count,
+        'error_rate': errors / count,
+        'ttfb_p50': percentile(ttfbs, 50),
+        'ttfb_p95': percentile(ttfbs, 95),
+        'tokens_per_second': statistics.mean(rates) if rates else float('nan'),
+        'requests_per_second': count / elapsed
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test an Ask LISA app')
+    parser.add_argument('--url', default='http://localhost:5000', help='Base URL of the app')
+    parser.add_argument('--question', default='What were the total sales for each product category?')
+    parser.add_argument('--levels', default='1,2,4,8,16', help='Comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=16, help='Number of requests at each level')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Timeout in seconds for each request')
+    parser.add_argument('--vary', action='store_true', help='Make each question unique so cached translations and answers are not reused')
+    args = parser.parse_args()
+
+    print(f'{"Concurrency":>11} {"Requests":>8} {"Errors":>7} {"TTFB p50":>9} {"TTFB p95":>9} {"Tokens/s":>9} {"Req/s":>7}')
+
+    for level in [int(level) for level in args.levels.split(',')]:
+        result = run_level(args.url, args.question, level, max(args.requests, level), args.timeout, args.vary)
+
+        print(f'{result["concurrency"]:>11} {result["requests"]:>8} {result["error_rate"]:>7.1%} '
+              f'{result["ttfb_p50"]:>8.2f}s {result["ttfb_p95"]:>8.2f}s {result["tokens_per_second"]:>9.1f} '
+              f'{result["requests_per_second"]:>7.2f}')
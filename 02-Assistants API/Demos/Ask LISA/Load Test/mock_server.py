@@ -0,0 +1,518 @@
+# Local stand-in for the parts of the OpenAI API used by the Ask LISA apps:
+# assistants, threads, messages, streaming runs (including function calls,
+# code interpreter steps, and image content), files, vector stores, and chat
+# completions. Files uploaded to vector stores are accepted but not searched,
+# so runs that use file_search answer with the same text as other runs.
+#
+# Start the server, then point an app at it before starting the app:
+#
+#   python mock_server.py --port 8000 --tokens-per-second 50
+#   export OPENAI_BASE_URL=http://localhost:8000/v1
+#   export OPENAI_API_KEY=mock
+#
+# GET /mock/stats returns counts of runs, cancellations, and other calls.
+
+import argparse, json, struct, threading, time, uuid, zlib
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+app = Flask(__name__)
+
+settings = {}
+lock = threading.Lock()
+assistants = {}
+threads = {}
+runs = {}
+active_runs = {}
+files = {}
+vector_stores = {}
+stats = { 'runs_created': 0, 'runs_completed': 0, 'runs_cancelled': 0, 'tool_outputs_submitted': 0,
+          'messages_rejected': 0, 'chat_completions': 0, 'files_downloaded': 0, 'files_uploaded': 0 }
+
+words = '''
+    Northwind sold more beverages than any other category last year, and the
+    trend continued into the first quarter. Dairy products came second, while
+    seafood and confections were close behind. Here is a summary of the numbers
+    you asked for, rounded to the nearest dollar.
+    '''.split()
+
+active_statuses = ['queued', 'in_progress', 'requires_action', 'cancelling']
+
+# Helper function for generating object IDs
+def new_id(prefix):
+    return f'{prefix}_{uuid.uuid4().hex[:24]}'
+
+# Helper function for incrementing a counter in the stats
+def count(name):
+    with lock:
+        stats[name] += 1
+
+# Helper function for returning an error in the format used by the OpenAI API
+def error(status, message):
+    body = { 'error': { 'message': message, 'type': 'invalid_request_error', 'param': None, 'code': None }}
+    return jsonify(body), status
+
+# Helper function for creating a solid black PNG image
+def create_png(width=320, height=240):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + b'\x00\x00\x00' * width for _ in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+image_bytes = create_png()
+
+# Helper function for formatting a server-sent event
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+# Helper function for creating a run step
+def new_step(run, step_type, step_details):
+    return {
+        'id': new_id('step'), 'object': 'thread.run.step', 'created_at': int(time.time()),
+        'run_id': run['id'], 'assistant_id': run['assistant_id'], 'thread_id': run['thread_id'],
+        'type': step_type, 'status': 'in_progress', 'step_details': step_details,
+        'last_error': None, 'expired_at': None, 'cancelled_at': None, 'failed_at': None,
+        'completed_at': None, 'metadata': {}, 'usage': None
+    }
+
+# Helper function for sleeping in small increments so a run can be cancelled
+def wait(run, seconds):
+    end = time.perf_counter() + seconds
+
+    while time.perf_counter() < end:
+        if run['status'] == 'cancelling':
+            return False
+
+        time.sleep(min(0.05, max(0, end - time.perf_counter())))
+
+    return run['status'] != 'cancelling'
+
+# Helper function for finishing a run in the background after a client stops
+# reading its stream, just as the real API keeps running it
+def finish_later(run, seconds):
+    def finish():
+        with lock:
+            if run['status'] in ['queued', 'in_progress']:
+                run['status'] = 'completed'
+                stats['runs_completed'] += 1
+            elif run['status'] == 'cancelling':
+                run['status'] = 'cancelled'
+                stats['runs_cancelled'] += 1
+
+    threading.Timer(seconds, finish).start()
+
+# Generator that streams the events for a run
+def stream_run(run, resume=False):
+    state = { 'finished': False, 'remaining': settings['tokens'] / settings['tokens_per_second'] }
+
+    try:
+        yield from run_events(run, resume, state)
+        state['finished'] = True
+        yield 'event: done\ndata: [DONE]\n\n'
+
+    finally:
+        if not state['finished']:
+            finish_later(run, state['remaining'])
+
+def run_events(run, resume, state):
+    assistant = assistants[run['assistant_id']]
+    thread = threads[run['thread_id']]
+    functions = [tool['function'] for tool in assistant['tools'] if tool['type'] == 'function']
+    code_interpreter = any(tool['type'] == 'code_interpreter' for tool in assistant['tools'])
+    question = thread['messages'][-1]['content'][0]['text']['value'] if thread['messages'] else ''
+
+    if resume:
+        # Complete the step that requested the function calls
+        step = run.pop('tool_step')
+        step.update(status='completed', completed_at=int(time.time()))
+        yield sse('thread.run.step.completed', step)
+    else:
+        yield sse('thread.run.created', run)
+
+    run['status'] = 'in_progress'
+    yield sse('thread.run.queued', { **run, 'status': 'queued' })
+    yield sse('thread.run.in_progress', run)
+
+    if not wait(run, settings['latency'] if not resume else settings['tool_latency']):
+        yield from cancel_events(run)
+        return
+
+    # Request function calls the first time through if the assistant has functions
+    if functions and not resume:
+        tool_calls = []
+
+        for function in functions:
+            properties = function.get('parameters', {}).get('properties', {})
+            arguments = { name: settings['sql'] if name == 'sql' else question
+                          for name, schema in properties.items() if schema.get('type') == 'string' }
+            tool_calls.append({ 'id': new_id('call'), 'type': 'function',
+                                'function': { 'name': function['name'], 'arguments': json.dumps(arguments) }})
+
+        step = new_step(run, 'tool_calls', { 'type': 'tool_calls', 'tool_calls': [
+            { **tool_call, 'function': { **tool_call['function'], 'output': None }} for tool_call in tool_calls
+        ]})
+
+        run['tool_step'] = step
+        run['status'] = 'requires_action'
+        run['required_action'] = { 'type': 'submit_tool_outputs', 'submit_tool_outputs': { 'tool_calls': tool_calls }}
+        yield sse('thread.run.step.created', step)
+        yield sse('thread.run.step.in_progress', step)
+        yield sse('thread.run.requires_action', run)
+        return
+
+    run['required_action'] = None
+
+    # Simulate the code interpreter if the user asked for a chart
+    chart = code_interpreter and any(word in question.lower() for word in ['chart', 'graph', 'plot'])
+
+    if chart:
+        tool_call = { 'id': new_id('call'), 'type': 'code_interpreter',
+                      'code_interpreter': { 'input': 'import matplotlib.pyplot as plt', 'outputs': [] }}
+        step = new_step(run, 'tool_calls', { 'type': 'tool_calls', 'tool_calls': [tool_call] })
+        yield sse('thread.run.step.created', step)
+        yield sse('thread.run.step.in_progress', step)
+
+        if not wait(run, settings['code_interpreter_latency']):
+            yield from cancel_events(run)
+            return
+
+        step.update(status='completed', completed_at=int(time.time()))
+        yield sse('thread.run.step.completed', step)
+
+    # Stream the assistant's response
+    message = {
+        'id': new_id('msg'), 'object': 'thread.message', 'created_at': int(time.time()),
+        'thread_id': thread['id'], 'role': 'assistant', 'content': [], 'assistant_id': assistant['id'],
+        'run_id': run['id'], 'attachments': [], 'metadata': {}, 'status': 'in_progress',
+        'incomplete_details': None, 'completed_at': None, 'incomplete_at': None
+    }
+
+    step = new_step(run, 'message_creation', { 'type': 'message_creation', 'message_creation': { 'message_id': message['id'] }})
+    yield sse('thread.run.step.created', step)
+    yield sse('thread.run.step.in_progress', step)
+    yield sse('thread.message.created', message)
+    yield sse('thread.message.in_progress', message)
+
+    index = 0
+
+    if chart:
+        file_id = new_id('file')
+        yield sse('thread.message.delta', { 'id': message['id'], 'object': 'thread.message.delta', 'delta': { 'content': [
+            { 'index': index, 'type': 'image_file', 'image_file': { 'file_id': file_id, 'detail': None }}
+        ]}})
+
+        message['content'].append({ 'type': 'image_file', 'image_file': { 'file_id': file_id, 'detail': None }})
+        index += 1
+
+    text = ''
+
+    for i in range(settings['tokens']):
+        if not wait(run, 1 / settings['tokens_per_second']):
+            yield from cancel_events(run)
+            return
+
+        token = words[i % len(words)] + ' '
+        text += token
+        state['remaining'] = (settings['tokens'] - i - 1) / settings['tokens_per_second']
+
+        yield sse('thread.message.delta', { 'id': message['id'], 'object': 'thread.message.delta', 'delta': { 'content': [
+            { 'index': index, 'type': 'text', 'text': { 'value': token, 'annotations': [] }}
+        ]}})
+
+    message['content'].append({ 'type': 'text', 'text': { 'value': text, 'annotations': [] }})
+    message.update(status='completed', completed_at=int(time.time()))
+    thread['messages'].append(message)
+    yield sse('thread.message.completed', message)
+
+    step.update(status='completed', completed_at=int(time.time()))
+    yield sse('thread.run.step.completed', step)
+
+    with lock:
+        run.update(status='completed', completed_at=int(time.time()))
+        stats['runs_completed'] += 1
+
+    yield sse('thread.run.completed', run)
+
+def cancel_events(run):
+    with lock:
+        run.update(status='cancelled', cancelled_at=int(time.time()))
+        stats['runs_cancelled'] += 1
+
+    yield sse('thread.run.cancelled', run)
+
+# Assistants
+@app.route('/v1/assistants', methods=['GET'])
+def list_assistants():
+    data = list(assistants.values())
+    return jsonify({ 'object': 'list', 'data': data, 'has_more': False,
+                     'first_id': data[0]['id'] if data else None, 'last_id': data[-1]['id'] if data else None })
+
+@app.route('/v1/assistants', methods=['POST'])
+def create_assistant():
+    body = request.get_json()
+
+    assistant = {
+        'id': new_id('asst'), 'object': 'assistant', 'created_at': int(time.time()),
+        'name': body.get('name'), 'description': None, 'model': body.get('model'),
+        'instructions': body.get('instructions'), 'tools': body.get('tools') or [],
+        'tool_resources': body.get('tool_resources') or {}, 'metadata': {},
+        'temperature': 1.0, 'top_p': 1.0, 'response_format': 'auto'
+    }
+
+    assistants[assistant['id']] = assistant
+    return jsonify(assistant)
+
+# Threads
+@app.route('/v1/threads', methods=['POST'])
+def create_thread():
+    thread = { 'id': new_id('thread'), 'object': 'thread', 'created_at': int(time.time()),
+               'metadata': {}, 'tool_resources': {}, 'messages': [] }
+
+    threads[thread['id']] = thread
+    return jsonify({ key: value for key, value in thread.items() if key != 'messages' })
+
+@app.route('/v1/threads/<thread_id>', methods=['GET'])
+def retrieve_thread(thread_id):
+    if thread_id not in threads:
+        return error(404, f"No thread found with id '{thread_id}'.")
+
+    return jsonify({ key: value for key, value in threads[thread_id].items() if key != 'messages' })
+
+# Messages
+@app.route('/v1/threads/<thread_id>/messages', methods=['POST'])
+def create_message(thread_id):
+    if thread_id not in threads:
+        return error(404, f"No thread found with id '{thread_id}'.")
+
+    thread = threads[thread_id]
+
+    # Each thread's most recent run is indexed, so only that run is checked
+    with lock:
+        run = active_runs.get(thread_id)
+
+        if run is not None and run['status'] in active_statuses:
+            stats['messages_rejected'] += 1
+            return error(400, f"Can't add messages to {thread_id} while a run {run['id']} is active.")
+
+    body = request.get_json()
+
+    message = {
+        'id': new_id('msg'), 'object': 'thread.message', 'created_at': int(time.time()),
+        'thread_id': thread_id, 'role': body.get('role', 'user'),
+        'content': [{ 'type': 'text', 'text': { 'value': body.get('content') or '', 'annotations': [] }}],
+        'assistant_id': None, 'run_id': None, 'attachments': [], 'metadata': {}, 'status': 'completed',
+        'incomplete_details': None, 'completed_at': None, 'incomplete_at': None
+    }
+
+    thread['messages'].append(message)
+    return jsonify(message)
+
+# Runs
+@app.route('/v1/threads/<thread_id>/runs', methods=['POST'])
+def create_run(thread_id):
+    if thread_id not in threads:
+        return error(404, f"No thread found with id '{thread_id}'.")
+
+    body = request.get_json()
+    assistant = assistants.get(body.get('assistant_id'))
+
+    if assistant is None:
+        return error(404, f"No assistant found with id '{body.get('assistant_id')}'.")
+
+    run = {
+        'id': new_id('run'), 'object': 'thread.run', 'created_at': int(time.time()),
+        'thread_id': thread_id, 'assistant_id': assistant['id'], 'status': 'queued',
+        'required_action': None, 'last_error': None, 'expires_at': None, 'started_at': None,
+        'cancelled_at': None, 'failed_at': None, 'completed_at': None, 'incomplete_details': None,
+        'model': assistant['model'], 'instructions': assistant['instructions'], 'tools': assistant['tools'],
+        'metadata': {}, 'usage': None, 'temperature': 1.0, 'top_p': 1.0, 'max_prompt_tokens': None,
+        'max_completion_tokens': None, 'truncation_strategy': { 'type': 'auto', 'last_messages': None },
+        'tool_choice': 'auto', 'parallel_tool_calls': True, 'response_format': 'auto'
+    }
+
+    with lock:
+        runs[run['id']] = run
+        active_runs[thread_id] = run
+        stats['runs_created'] += 1
+
+    if not body.get('stream'):
+        return error(400, 'The mock server only supports streaming runs.')
+
+    return Response(stream_with_context(stream_run(run)), mimetype='text/event-stream')
+
+@app.route('/v1/threads/<thread_id>/runs/<run_id>', methods=['GET'])
+def retrieve_run(thread_id, run_id):
+    if run_id not in runs:
+        return error(404, f"No run found with id '{run_id}'.")
+
+    return jsonify({ key: value for key, value in runs[run_id].items() if key != 'tool_step' })
+
+@app.route('/v1/threads/<thread_id>/runs/<run_id>/submit_tool_outputs', methods=['POST'])
+def submit_tool_outputs(thread_id, run_id):
+    run = runs.get(run_id)
+
+    if run is None:
+        return error(404, f"No run found with id '{run_id}'.")
+
+    if run['status'] != 'requires_action':
+        return error(400, f"Runs in status \"{run['status']}\" do not accept tool outputs.")
+
+    count('tool_outputs_submitted')
+    run['status'] = 'queued'
+    return Response(stream_with_context(stream_run(run, resume=True)), mimetype='text/event-stream')
+
+@app.route('/v1/threads/<thread_id>/runs/<run_id>/cancel', methods=['POST'])
+def cancel_run(thread_id, run_id):
+    run = runs.get(run_id)
+
+    if run is None:
+        return error(404, f"No run found with id '{run_id}'.")
+
+    with lock:
+        if run['status'] not in active_statuses:
+            return error(400, f"Cannot cancel run with status '{run['status']}'.")
+
+        if run['status'] == 'requires_action':
+            run.update(status='cancelled', cancelled_at=int(time.time()))
+            stats['runs_cancelled'] += 1
+        else:
+            run['status'] = 'cancelling'
+
+    return jsonify({ key: value for key, value in run.items() if key != 'tool_step' })
+
+# Files
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+def file_content(file_id):
+    count('files_downloaded')
+    time.sleep(settings['latency'])
+    return Response(image_bytes, mimetype='image/png')
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    upload = request.files.get('file')
+
+    if upload is None:
+        return error(400, 'No file was uploaded.')
+
+    file = {
+        'id': new_id('file'), 'object': 'file', 'bytes': len(upload.read()), 'created_at': int(time.time()),
+        'filename': upload.filename, 'purpose': request.form.get('purpose', 'assistants'), 'status': 'processed',
+        'status_details': None
+    }
+
+    with lock:
+        files[file['id']] = file
+        stats['files_uploaded'] += 1
+
+    return jsonify(file)
+
+# Vector stores (used by 3-RAG). Files are added to vector stores immediately.
+@app.route('/v1/vector_stores', methods=['GET'])
+def list_vector_stores():
+    with lock:
+        data = list(vector_stores.values())
+
+    return jsonify({ 'object': 'list', 'data': data, 'has_more': False,
+                     'first_id': data[0]['id'] if data else None, 'last_id': data[-1]['id'] if data else None })
+
+@app.route('/v1/vector_stores', methods=['POST'])
+def create_vector_store():
+    body = request.get_json()
+
+    vector_store = {
+        'id': new_id('vs'), 'object': 'vector_store', 'created_at': int(time.time()), 'name': body.get('name'),
+        'usage_bytes': 0, 'status': 'completed', 'last_active_at': int(time.time()), 'metadata': {},
+        'expires_after': None, 'expires_at': None,
+        'file_counts': { 'in_progress': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'total': 0 }
+    }
+
+    with lock:
+        vector_stores[vector_store['id']] = vector_store
+
+    return jsonify(vector_store)
+
+# Helper function for creating a completed file batch
+def new_file_batch(vector_store_id, file_count):
+    return {
+        'id': new_id('vsfb'), 'object': 'vector_store.file_batch', 'created_at': int(time.time()),
+        'vector_store_id': vector_store_id, 'status': 'completed',
+        'file_counts': { 'in_progress': 0, 'completed': file_count, 'failed': 0, 'cancelled': 0, 'total': file_count }
+    }
+
+@app.route('/v1/vector_stores/<vector_store_id>/file_batches', methods=['POST'])
+def create_file_batch(vector_store_id):
+    body = request.get_json()
+
+    with lock:
+        vector_store = vector_stores.get(vector_store_id)
+
+        if vector_store is None:
+            return error(404, f"No vector store found with id '{vector_store_id}'.")
+
+        file_ids = body.get('file_ids') or []
+        missing = [file_id for file_id in file_ids if file_id not in files]
+
+        if missing:
+            return error(404, f"No file found with id '{missing[0]}'.")
+
+        counts = vector_store['file_counts']
+        counts['completed'] += len(file_ids)
+        counts['total'] += len(file_ids)
+        vector_store['usage_bytes'] += sum(files[file_id]['bytes'] for file_id in file_ids)
+
+    return jsonify(new_file_batch(vector_store_id, len(file_ids)))
+
+@app.route('/v1/vector_stores/<vector_store_id>/file_batches/<batch_id>', methods=['GET'])
+def retrieve_file_batch(vector_store_id, batch_id):
+    if vector_store_id not in vector_stores:
+        return error(404, f"No vector store found with id '{vector_store_id}'.")
+
+    # Batches complete as soon as they're created, so the file count isn't kept
+    return jsonify({ **new_file_batch(vector_store_id, 0), 'id': batch_id })
+
+# Chat completions (used by text2sql)
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    count('chat_completions')
+    body = request.get_json()
+    time.sleep(settings['latency'])
+    content = settings['sql']
+
+    if body.get('stream'):
+        def generate():
+            for word in content.split(' '):
+                time.sleep(1 / settings['tokens_per_second'])
+                chunk = { 'id': new_id('chatcmpl'), 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                          'model': body.get('model'), 'choices': [{ 'index': 0, 'delta': { 'content': word + ' ' }, 'finish_reason': None }]}
+                yield f'data: {json.dumps(chunk)}\n\n'
+
+            yield 'data: [DONE]\n\n'
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+    return jsonify({
+        'id': new_id('chatcmpl'), 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+        'choices': [{ 'index': 0, 'message': { 'role': 'assistant', 'content': content }, 'finish_reason': 'stop' }],
+        'usage': { 'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120 }
+    })
+
+# Statistics for load tests
+@app.route('/mock/stats', methods=['GET'])
+def get_stats():
+    with lock:
+        return jsonify(stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI Assistants API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds before a run starts responding')
+    parser.add_argument('--tool-latency', type=float, default=0.3, help='Seconds before a run resumes after tool outputs are submitted')
+    parser.add_argument('--code-interpreter-latency', type=float, default=2.0, help='Seconds the simulated code interpreter runs')
+    parser.add_argument('--tokens', type=int, default=60, help='Number of tokens in each response')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--sql', default='SELECT CategoryName, Description FROM Categories', help='SQL returned by chat completions and passed to tools with a sql parameter')
+    args = parser.parse_args()
+
+    settings.update(vars(args))
+    app.run(port=args.port, threaded=True)
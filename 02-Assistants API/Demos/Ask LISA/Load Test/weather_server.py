@@ -0,0 +1,67 @@
+# Local stand-in for the OpenWeather current weather API used by the
+# get_current_weather tool in 4-Functions. Returns made-up but consistent
+# conditions for any location after a configurable delay.
+#
+# Start the server, then point the app at it before starting the app:
+#
+#   python weather_server.py --port 8001 --latency 0.3
+#   export OPENWEATHER_BASE_URL=http://localhost:8001
+#   export OPENWEATHER_API_KEY=stub
+#
+# GET /stub/stats returns the number of requests received for each location.
+
+import argparse, hashlib, threading, time
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+settings = {}
+lock = threading.Lock()
+stats = {}
+
+# Weather API
+@app.route('/data/2.5/weather', methods=['GET'])
+def get_weather():
+    location = request.args.get('q', '')
+
+    with lock:
+        stats[location] = stats.get(location, 0) + 1
+
+    time.sleep(settings['latency'])
+
+    if request.args.get('appid') is None:
+        return jsonify({ 'cod': 401, 'message': 'Invalid API key.' }), 401
+
+    if location.strip() == '' or location.lower().startswith('nowhere'):
+        return jsonify({ 'cod': '404', 'message': 'city not found' }), 404
+
+    # Derive the conditions from the location so repeated lookups agree
+    seed = int(hashlib.sha256(location.lower().encode()).hexdigest(), 16)
+    name = location.split(',')[0].strip().title()
+    temp = round(20 + seed % 700 / 10, 2)
+
+    return jsonify({
+        'coord': { 'lon': round(seed % 36000 / 100 - 180, 4), 'lat': round(seed % 18000 / 100 - 90, 4) },
+        'weather': [{ 'id': 800, 'main': 'Clear', 'description': 'clear sky', 'icon': '01d' }],
+        'main': { 'temp': temp, 'feels_like': temp, 'temp_min': temp - 2, 'temp_max': temp + 2,
+                  'pressure': 1013, 'humidity': seed % 100 },
+        'wind': { 'speed': seed % 200 / 10, 'deg': seed % 360 },
+        'sys': { 'country': location.split(',')[-1].strip().upper()[:2] if ',' in location else 'US' },
+        'name': name,
+        'cod': 200
+    })
+
+# Statistics for tests
+@app.route('/stub/stats', methods=['GET'])
+def get_stats():
+    with lock:
+        return jsonify(stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenWeather API')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds before each response')
+    args = parser.parse_args()
+
+    settings.update(vars(args))
+    app.run(port=args.port, threaded=True)
@@ -0,0 +1,140 @@
+# Precomputed aggregates for the Stocks table. DailyStats holds each stock's
+# daily return and 20-, 50-, and 200-day moving averages of the closing price,
+# and MonthlyPrices holds each stock's monthly open, high, low, close, and
+# volume. Questions about trends and moving averages can then be answered with
+# indexed lookups instead of window functions over the whole Stocks table.
+#
+# The aggregates are refreshed incrementally: only the days after the last day
+# already computed for each stock are added, along with the month they fall in.
+# The app refreshes them when it starts and whenever the database changes, and
+# this script does the same from the command line. Use --rebuild to recompute
+# everything, for example after prices were corrected.
+#
+#   python aggregates.py --database data/nasdaq.db
+
+import argparse, sqlite3, time
+
+# Moving-average windows in days. DailyStats has an MA column for each one.
+MOVING_AVERAGES = [20, 50, 200]
+
+# Tables that hold the aggregates
+AGGREGATE_TABLES = ['DailyStats', 'MonthlyPrices']
+
+# Helper function for creating the aggregate tables if they don't exist
+def create_tables(connection):
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS DailyStats (
+            Symbol TEXT NOT NULL,
+            Date DATE NOT NULL,
+            Close NUMERIC NOT NULL,
+            DailyReturn NUMERIC,
+            MA20 NUMERIC,
+            MA50 NUMERIC,
+            MA200 NUMERIC,
+            PRIMARY KEY (Symbol, Date)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS MonthlyPrices (
+            Symbol TEXT NOT NULL,
+            Month TEXT NOT NULL,
+            Open NUMERIC NOT NULL,
+            High NUMERIC NOT NULL,
+            Low NUMERIC NOT NULL,
+            Close NUMERIC NOT NULL,
+            Volume INT NOT NULL,
+            PRIMARY KEY (Symbol, Month)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS idx_Stocks_Symbol_Date ON Stocks (Symbol, Date);
+    ''')
+
+# Helper function for adding the days after the last day computed for a stock
+# to DailyStats. Moving averages need the closing prices of earlier days, so
+# the window functions start far enough back to cover the longest average.
+# Averages are left NULL until there are enough days to compute them.
+def refresh_daily_stats(connection, symbol):
+    last = connection.execute('SELECT MAX(Date) FROM DailyStats WHERE Symbol = ?', (symbol,)).fetchone()[0]
+    start = None
+
+    if last is not None:
+        row = connection.execute(
+            'SELECT Date FROM Stocks WHERE Symbol = ? AND Date <= ? ORDER BY Date DESC LIMIT 1 OFFSET ?',
+            (symbol, last, max(MOVING_AVERAGES) - 1)
+        ).fetchone()
+
+        start = row[0] if row is not None else None
+
+    averages = ''.join(
+        f'''
+            CASE WHEN COUNT(*) OVER (ORDER BY Date ROWS {days - 1} PRECEDING) = {days}
+                THEN AVG(Close) OVER (ORDER BY Date ROWS {days - 1} PRECEDING) END,'''
+        for days in MOVING_AVERAGES
+    )
+
+    cursor = connection.execute(f'''
+        INSERT OR REPLACE INTO DailyStats
+        SELECT * FROM (
+            SELECT Symbol, Date, Close,
+                Close * 1.0 / LAG(Close) OVER (ORDER BY Date) - 1,{averages.rstrip(',')}
+            FROM Stocks
+            WHERE Symbol = ? AND Date >= ?
+        )
+        WHERE Date > ?
+        ''', (symbol, start or '', last or ''))
+
+    return cursor.rowcount
+
+# Helper function for recomputing the months that days were added to since
+# the last refresh. The current month is recomputed as days are added to it.
+def refresh_monthly_prices(connection, symbol, since):
+    connection.execute('''
+        INSERT OR REPLACE INTO MonthlyPrices
+        SELECT Symbol, Month,
+            MAX(CASE WHEN FirstDay = 1 THEN Open END), MAX(High), MIN(Low),
+            MAX(CASE WHEN LastDay = 1 THEN Close END), SUM(Volume)
+        FROM (
+            SELECT Symbol, substr(Date, 1, 7) AS Month, Open, High, Low, Close, Volume,
+                ROW_NUMBER() OVER (PARTITION BY substr(Date, 1, 7) ORDER BY Date) AS FirstDay,
+                ROW_NUMBER() OVER (PARTITION BY substr(Date, 1, 7) ORDER BY Date DESC) AS LastDay
+            FROM Stocks
+            WHERE Symbol = ? AND Date >= ?
+        )
+        GROUP BY Symbol, Month
+        ''', (symbol, since[:7]))
+
+# Helper function for refreshing the aggregates for every stock. Returns the
+# number of days added.
+def refresh_aggregates(path, rebuild=False):
+    connection = sqlite3.connect(path)
+
+    try:
+        with connection:
+            if rebuild:
+                connection.executescript('DROP TABLE IF EXISTS DailyStats; DROP TABLE IF EXISTS MonthlyPrices;')
+
+            create_tables(connection)
+            added = 0
+
+            for (symbol,) in connection.execute('SELECT DISTINCT Symbol FROM Stocks').fetchall():
+                last = connection.execute('SELECT MAX(Date) FROM DailyStats WHERE Symbol = ?', (symbol,)).fetchone()[0]
+                count = refresh_daily_stats(connection, symbol)
+
+                if count > 0:
+                    refresh_monthly_prices(connection, symbol, last or '')
+
+                added += count
+
+        return added
+
+    finally:
+        connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the precomputed aggregates in the stocks database')
+    parser.add_argument('--database', default='data/nasdaq.db', help='Path of the stocks database')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the aggregates from scratch')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    added = refresh_aggregates(args.database, args.rebuild)
+    print(f'Added {added} days to the aggregates in {time.perf_counter() - start:.2f} seconds')
@@ -1,13 +1,19 @@
-import base64
+import time
 from openai import OpenAI
-from flask import Flask, render_template, request, Response, stream_with_context, make_response
+from flask import Flask, render_template, request, stream_with_context, make_response, send_file, abort, jsonify
 from helpers import *
+from metrics import get_metrics, record_timing
+from tools import call_tools
 
 client = OpenAI()
 
+# Bring the precomputed aggregates up to date before they're described to the
+# assistant
+refresh_database()
+
 assistant = get_or_create_assistant(
     client,
-    'LISA-stocks',
+    get_assistant_name('LISA-stocks'),
     instructions='''
         You are a friendly assistant named LISA who can answer questions about stock prices and
         can illustrate your answers by generating charts and graphs. When asked about stock prices,
@@ -15,12 +21,15 @@ assistant = get_or_create_assistant(
         are in dollars. Round such amounts to the nearest dollar in your output, and use commas
         as separators for amounts greater than $999. Use a black background with light text and
         graphics for any charts you produce. Do not return any markdown in your text responses.
-        ''',
-    tools=[database_tool, { 'type': 'code_interpreter' }]
+        ''' + get_sql_instructions(),
+    tools=[get_database_tool(), chart_tool, { 'type': 'code_interpreter' }]
 )
 
 app = Flask(__name__)
 
+# Start the workers that render charts for the render_chart tool
+warm_chart_pool()
+
 # Home page
 @app.route('/', methods=['GET'])
 def index():
@@ -29,6 +38,8 @@ def index():
 # REST method for invoking the Assistants API
 @app.route('/assistant', methods=['get'])
 def ask_assistant():
+    start = time.perf_counter()
+
     try:
         # If the request contains a thread ID, retrieve the thread.
         # Otherwise, create a new thread.
@@ -39,108 +50,192 @@ def ask_assistant():
         else:
             thread = client.beta.threads.retrieve(thread_id)
 
-        # Add a message to the thread
-        input = request.args.get('input')
-
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role='user',
-            content=input
-        )
-
-        # Create a streaming run
-        main_stream = client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=assistant.id,
-            stream=True
-        )
-
-        for event in main_stream:
-            # If text is starting to stream back, wrap the stream
-            # in a generator and return the generator to the client
-            if event.event == 'thread.message.created':
-                response = make_response(stream_with_context(generate(main_stream)))
-                response.headers['X-Thread-ID'] = thread.id
-                return response
-
-            # If one or more function calls are required, execute the calls
-            # and submit the output to the Assistants API. Then take the NEW
-            # stream that's created, wrap it in a generator, and return the
-            # generator to the client.
-            if event.event == 'thread.run.requires_action':
-                tool_outputs = []
-
-                for tool_call in event.data.required_action.submit_tool_outputs.tool_calls:
-                    function_name = tool_call.function.name
-
-                    if function_name == 'query_database':
-                        print('Calling query_database()')
-                        input = json.loads(tool_call.function.arguments)['input']
-                        output = query_database(input)
-                    else:
-                        raise Exception('Invalid function name')
-
-                    tool_output = {
-                        'tool_call_id': tool_call.id,
-                        'output': output
-                    }
-
-                    tool_outputs.append(tool_output)
-
-                # Pass the tool output(s) to the Assistants API
-                tool_stream = client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread.id,
-                    run_id=event.data.id,
-                    tool_outputs=tool_outputs,
-                    stream=True
-                )
-
-                # Return the new stream to the client and include the thread ID
-                response = make_response(stream_with_context(generate(tool_stream)))
-                response.headers['X-Thread-ID'] = thread.id
-                return response
+        # Wait until earlier requests on this thread are finished. Requests
+        # for the same thread are processed one at a time in the order received.
+        acquire_thread(thread.id)
 
-        # Return an error message if the stream ends unexpectedly
-        response = make_response(stream_with_context('Oops! Can you try that again?'))
-        response.headers['X-Thread-ID'] = thread.id
-        return response      
+        try:
+            # Add a message to the thread
+            input = request.args.get('input')
+            add_message(client, thread.id, input)
+
+            # Create a streaming run
+            main_stream = client.beta.threads.runs.create(
+                thread_id=thread.id,
+                assistant_id=assistant.id,
+                stream=True
+            )
+
+            # Wrap the stream in a generator and return the generator to the client
+            response = make_response(stream_with_context(generate(thread.id, main_stream, start)))
+
+        except Exception as e:
+            release_thread(thread.id)
+            raise
+
+        # Let the next request for this thread proceed when the response is complete
+        response.call_on_close(lambda: release_thread(thread.id))
 
     except Exception as e:
         # Return an error message if something goes wrong
-        if "Can't add messages to thread" in str(e):
-            response = make_response(stream_with_context("Give me a moment. I'm still working on your previous request."))
+        if isinstance(e, ThreadBusyError):
+            message = "Give me a moment. I'm still working on your previous requests."
         else:
-            response = make_response(stream_with_context("I'm sorry, but something went wrong."))
+            message = "I'm sorry, but something went wrong."
+
+        response = make_response(stream_with_context(generate_message(message)))
 
-        response.headers['X-Thread-ID'] = thread.id
-        return response
+    # Return the response and include the thread ID
+    response.mimetype = 'application/x-ndjson'
+    response.headers['X-Thread-ID'] = thread.id
+    return response
 
 # REST method for downloading images
 @app.route('/image', methods=['get'])
 def get_image():
     file_id = request.args.get('id')
-    image_file = client.files.content(file_id)
-    image_bytes = image_file.read()
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    src = f'data:image/png;base64,{base64_image}'
-    return Response(src)
-
-def generate(stream):
-    for event in stream:
-        if event.event == 'thread.message.created':
-            for content in event.data.content or []:
-                if content.type == 'text' and content.text and content.text.value:
-                   # Output the latest chunk of text
-                    yield content.text.value
-                elif content.type == 'image_file' and content.image_file and content.image_file.file_id:
-                    # Output an image file ID
-                    yield f'[[[IMAGEID]]]{content.image_file.file_id}'
-
-        elif event.event == 'thread.message.delta':
-            for content in event.data.delta.content or []:
-                if content.type == 'text' and content.text and content.text.value:
-                   # Output the latest chunk of text
-                    yield content.text.value
-                elif content.type == 'image_file' and content.image_file and content.image_file.file_id:
-                    # Output an image file ID
-                    yield f'[[[IMAGEID]]]{content.image_file.file_id}'
+
+    if file_id is None or not is_valid_file_id(file_id):
+        abort(400)
+
+    # Charts rendered by render_chart exist only in the local cache, and are
+    # rendered again from their specs if their images are missing. Other
+    # images are downloaded only if they aren't already in the local cache.
+    if file_id.startswith('chart-'):
+        path = get_chart_image(file_id)
+
+        if path is None:
+            abort(404)
+    else:
+        path = get_cached_image(client, file_id)
+
+    # Return the raw PNG. Files never change once created, so the file ID
+    # doubles as the ETag and browsers can cache the image indefinitely.
+    return send_file(path, mimetype='image/png', etag=file_id, conditional=True, max_age=IMAGE_MAX_AGE)
+
+# REST method for retrieving metrics
+@app.route('/metrics', methods=['get'])
+def metrics():
+    return jsonify(get_metrics())
+
+# Generator for streaming output as newline-delimited JSON events. Each event
+# has a type: "text" for a chunk of text, "image" for an image file ID, "tool"
+# when a tool starts or finishes running, and "done" at the end of the response.
+# If the client disconnects before the run is finished, the run is cancelled so
+# it stops consuming tokens and code interpreter time. The time taken by
+# complete responses is recorded separately for each SQL mode.
+def generate(thread_id, stream, start):
+    output_sent = False
+    tool_steps = set()
+    run_id = None
+    run_finished = False
+
+    try:
+        while stream is not None:
+            next_stream = None
+
+            for event in stream:
+                # Keep track of the run so it can be cancelled
+                if event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step.'):
+                    run_id = event.data.id
+                    run_finished = event.event in run_end_events
+
+                if event.event == 'thread.message.created':
+                    contents = event.data.content
+
+                elif event.event == 'thread.message.delta':
+                    contents = event.data.delta.content
+
+                elif event.event in ['thread.run.step.created', 'thread.run.step.delta']:
+                    # Report code interpreter activity, which happens on the server
+                    step_details = event.data.step_details if event.event == 'thread.run.step.created' else event.data.delta.step_details
+
+                    if step_details and step_details.type == 'tool_calls' and event.data.id not in tool_steps:
+                        for tool_call in step_details.tool_calls or []:
+                            if tool_call.type == 'code_interpreter':
+                                tool_steps.add(event.data.id)
+                                yield format_event('tool', name='code_interpreter', status='running')
+                                break
+
+                    continue
+
+                elif event.event == 'thread.run.step.completed':
+                    if event.data.id in tool_steps:
+                        yield format_event('tool', name='code_interpreter', status='done')
+
+                    continue
+
+                elif event.event == 'thread.run.requires_action':
+                    # If one or more function calls are required, execute the calls
+                    # and submit the output to the Assistants API. Then continue with
+                    # the NEW stream that's created.
+                    tool_calls = event.data.required_action.submit_tool_outputs.tool_calls
+
+                    for tool_call in tool_calls:
+                        yield format_event('tool', name=tool_call.function.name, status='running')
+
+                    tool_outputs = call_tools(tool_calls)
+
+                    for tool_call in tool_calls:
+                        yield format_event('tool', name=tool_call.function.name, status='done')
+
+                    # Output charts rendered locally by render_chart
+                    for image_id in get_chart_ids(tool_calls, tool_outputs):
+                        output_sent = True
+                        yield format_event('image', id=image_id)
+
+                    next_stream = client.beta.threads.runs.submit_tool_outputs(
+                        thread_id=thread_id,
+                        run_id=event.data.id,
+                        tool_outputs=tool_outputs,
+                        stream=True
+                    )
+
+                    stream.close()
+                    break
+
+                else:
+                    continue
+
+                for content in contents or []:
+                    if content.type == 'text' and content.text and content.text.value:
+                        # Output the latest chunk of text
+                        output_sent = True
+                        yield format_event('text', text=content.text.value)
+                    elif content.type == 'image_file' and content.image_file and content.image_file.file_id:
+                        # Output an image file ID
+                        output_sent = True
+                        yield format_event('image', id=content.image_file.file_id)
+
+            stream = next_stream
+
+        # Return an error message if the stream ends unexpectedly
+        if not output_sent:
+            yield format_event('text', text='Oops! Can you try that again?')
+
+        record_timing(f'response_{SQL_MODE}', time.perf_counter() - start)
+
+    except GeneratorExit:
+        # The client disconnected before the response was complete
+        increment_counter('client_disconnects')
+
+        if run_id is not None and not run_finished:
+            cancel_run(client, thread_id, run_id)
+
+        raise
+
+    except Exception as e:
+        # Return an error message if something goes wrong
+        yield format_event('text', text="I'm sorry, but something went wrong.")
+
+    finally:
+        # Close the connection to the Assistants API
+        if stream is not None:
+            stream.close()
+
+    yield format_event('done')
+
+# Generator for returning a message that doesn't come from the Assistants API
+def generate_message(message):
+    yield format_event('text', text=message)
+    yield format_event('done')
@@ -0,0 +1,127 @@
+import os, json, hashlib, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from metrics import increment_counter, record_timing
+
+# Settings for rendering charts. Charts are drawn with matplotlib in a pool of
+# worker processes, since matplotlib isn't thread-safe and drawing is CPU-bound.
+CHART_WORKERS = 2
+CHART_TIMEOUT = 30
+CHART_TYPES = ['line', 'bar', 'scatter']
+
+chart_pool = None
+chart_pool_lock = threading.Lock()
+
+# Exception raised when a chart can't be rendered
+class ChartError(Exception):
+    pass
+
+# Helper function for getting the pool of chart workers, which is created the
+# first time a chart is rendered
+def get_chart_pool():
+    global chart_pool
+
+    with chart_pool_lock:
+        if chart_pool is None:
+            chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+
+        return chart_pool
+
+# Helper function for loading matplotlib in a worker process
+def load_matplotlib():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+
+# Helper function for starting the chart workers and loading matplotlib in
+# each one ahead of time, so the first charts don't wait for it
+def warm_chart_pool():
+    pool = get_chart_pool()
+
+    for _ in range(CHART_WORKERS):
+        pool.submit(load_matplotlib)
+
+# Helper function for computing the ID of a chart from everything that affects
+# how it looks. Charts with the same ID are drawn only once.
+def get_chart_id(spec, version):
+    text = json.dumps({ 'spec': spec, 'version': version }, sort_keys=True)
+    return f'chart-{hashlib.sha256(text.encode()).hexdigest()[:32]}'
+
+# Helper function for drawing a chart in a worker process and saving it as a
+# PNG. The chart is written to a temporary file first so other requests never
+# see a partial image.
+def draw_chart(spec, columns, rows, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    x = [row[columns.index(spec['x'])] for row in rows]
+
+    with plt.style.context('dark_background'):
+        figure, axes = plt.subplots(figsize=(8, 4.5), dpi=100)
+
+        for column in spec['y']:
+            y = [row[columns.index(column)] for row in rows]
+
+            if spec['type'] == 'bar':
+                axes.bar(x, y, label=column)
+            elif spec['type'] == 'scatter':
+                axes.scatter(x, y, label=column, s=12)
+            else:
+                axes.plot(x, y, label=column, linewidth=1.5)
+
+        axes.set_title(spec.get('title') or '')
+        axes.set_xlabel(spec.get('x_label') or spec['x'])
+        axes.set_ylabel(spec.get('y_label') or '')
+
+        if len(spec['y']) > 1:
+            axes.legend()
+
+        # Show at most about ten labels on the x axis
+        if len(x) > 10 and isinstance(x[0], str):
+            step = (len(x) + 9) // 10
+            axes.set_xticks(range(0, len(x), step), [x[i] for i in range(0, len(x), step)])
+
+        figure.autofmt_xdate()
+        figure.tight_layout()
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        figure.savefig(temp_path, format='png')
+        plt.close(figure)
+
+    os.replace(temp_path, path)
+
+# Helper function for rendering a chart of a query result into a directory.
+# Returns the chart's ID, which is also the name of the PNG file without the
+# extension, and whether the chart was rendered. Charts that were rendered
+# before are reused.
+def render_chart_image(spec, result, version, directory):
+    for column in [spec['x']] + spec['y']:
+        if column not in result['columns']:
+            raise ChartError(f'The query result has no column named "{column}". Its columns are {", ".join(result["columns"])}.')
+
+    if spec['type'] not in CHART_TYPES:
+        raise ChartError(f'Unsupported chart type "{spec["type"]}". Use one of {", ".join(CHART_TYPES)}.')
+
+    chart_id = get_chart_id(spec, version)
+    path = os.path.join(directory, f'{chart_id}.png')
+
+    if os.path.exists(path):
+        increment_counter('chart_cache_hits')
+        os.utime(path) # Mark the chart as recently used
+        return chart_id, False
+
+    increment_counter('chart_cache_misses')
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+
+    try:
+        future = get_chart_pool().submit(draw_chart, spec, result['columns'], result['rows'], path)
+        future.result(timeout=CHART_TIMEOUT)
+    except ImportError:
+        raise ChartError('Charts can\'t be rendered because matplotlib isn\'t installed.')
+    except Exception as e:
+        increment_counter('chart_errors')
+        raise ChartError(f'The chart could not be rendered: {e}')
+
+    record_timing('chart_render', time.perf_counter() - start)
+    return chart_id, True
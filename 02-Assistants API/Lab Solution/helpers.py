@@ -1,5 +1,22 @@
-import json, sqlite3, re
-from openai import OpenAI
+import os, json, re, sqlite3, tempfile, threading, time
+from collections import deque
+from openai import OpenAI, BadRequestError
+from metrics import increment_counter, record_timing
+from tools import register_tool
+from aggregates import AGGREGATE_TABLES, refresh_aggregates
+from charts import ChartError, CHART_TYPES, CHART_TIMEOUT, CHART_WORKERS, render_chart_image, warm_chart_pool
+from database import QueryError, QUERY_TIMEOUT, POOL_SIZE, run_query, validate_sql, get_database_version, get_cached_translation, cache_translation, get_schema, link_schema, format_schema
+
+# Database targeted by the query_database tool
+DATABASE_PATH = 'data/nasdaq.db'
+
+# How the assistant queries the database. In "text2sql" mode, the assistant
+# passes questions to the query_database tool, which asks another model to
+# write the SQL. In "sql" mode, the assistant writes the SQL itself from the
+# schema in its instructions and passes it to the run_sql tool, which saves
+# a model round trip for each query. Set the SQL_MODE environment variable to
+# choose a mode.
+SQL_MODE = os.environ.get('SQL_MODE', 'text2sql')
 
 # Helper method for retrieving an existing assistant or creating a new one
 def get_or_create_assistant(client, name, instructions, tools=None, tool_resources=None):
@@ -17,12 +34,124 @@ def get_or_create_assistant(client, name, instructions, tools=None, tool_resourc
 
     return assistant
 
+# Events that signal the end of a run
+run_end_events = [
+    'thread.run.completed', 'thread.run.incomplete', 'thread.run.failed',
+    'thread.run.cancelled', 'thread.run.expired'
+]
+
+# Helper function for cancelling a run whose output is no longer needed
+def cancel_run(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        increment_counter('runs_cancelled')
+    except Exception as e:
+        # The run may have finished in the meantime
+        increment_counter('run_cancel_errors')
+
+# Settings for the queue of requests waiting for a thread
+MAX_THREAD_QUEUE_DEPTH = 5
+THREAD_QUEUE_TIMEOUT = 300
+
+# Exception raised when a request can't be queued for a thread
+class ThreadBusyError(Exception):
+    pass
+
+thread_queues = {}
+thread_queues_lock = threading.Lock()
+
+# Helper function for waiting until no other request is using a thread.
+# Requests for the same thread are admitted one at a time in FIFO order.
+def acquire_thread(thread_id):
+    start = time.perf_counter()
+
+    with thread_queues_lock:
+        queue = thread_queues.get(thread_id)
+
+        if queue is None:
+            queue = {
+                'busy': False,
+                'waiting': deque(),
+                'condition': threading.Condition(thread_queues_lock)
+            }
+
+            thread_queues[thread_id] = queue
+
+        if len(queue['waiting']) >= MAX_THREAD_QUEUE_DEPTH:
+            increment_counter('thread_queue_rejections')
+            raise ThreadBusyError(f'Too many requests waiting for thread {thread_id}')
+
+        ticket = object()
+        queue['waiting'].append(ticket)
+
+        while queue['busy'] or queue['waiting'][0] is not ticket:
+            remaining = start + THREAD_QUEUE_TIMEOUT - time.perf_counter()
+
+            if remaining <= 0:
+                queue['waiting'].remove(ticket)
+                queue['condition'].notify_all()
+                increment_counter('thread_queue_timeouts')
+                raise ThreadBusyError(f'Timed out waiting for thread {thread_id}')
+
+            queue['condition'].wait(remaining)
+
+        queue['waiting'].popleft()
+        queue['busy'] = True
+
+    record_timing('thread_queue_wait', time.perf_counter() - start)
+
+# Helper function for letting the next request waiting for a thread proceed
+def release_thread(thread_id):
+    with thread_queues_lock:
+        queue = thread_queues[thread_id]
+        queue['busy'] = False
+
+        if len(queue['waiting']) == 0:
+            del thread_queues[thread_id]
+        else:
+            queue['condition'].notify_all()
+
+# Helper function for adding a message to a thread. If a run started outside
+# this process (or one that's being cancelled) is still active on the thread,
+# wait for it to finish rather than reject the message.
+def add_message(client, thread_id, content):
+    start = time.perf_counter()
+
+    while True:
+        try:
+            return client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role='user',
+                content=content
+            )
+
+        except BadRequestError as e:
+            if "Can't add messages to thread" not in str(e) or time.perf_counter() - start > THREAD_QUEUE_TIMEOUT:
+                raise
+
+            increment_counter('active_run_waits')
+            time.sleep(0.5)
+
 # Tool function
 def query_database(input):
+    refresh_database()
+    start = time.perf_counter()
     sql = text2sql(input)
+    record_timing('text2sql', time.perf_counter() - start)
+    return run_sql(sql)
+
+# Tool function for direct-SQL mode
+def run_sql(sql):
     print(sql) # Show the query in the host window
-    result = execute_sql(sql)
-    return json.dumps(result)
+    refresh_database()
+
+    try:
+        result = execute_sql(sql)
+    except QueryError as e:
+        print(e)
+        return json.dumps({ 'error': str(e) })
+
+    return json.dumps(result, separators=(',', ':'), default=str)
 
 # Tool description
 database_tool = {
@@ -45,6 +174,12 @@ database_tool = {
                 Close NUMERIC NOT NULL, -- Closing price of the stock on that date
                 Volume INT NOT NULL     -- Number of shares traded on that date
             )
+
+            Results are returned as JSON containing the column names, up to
+            100 rows, and the total row count. If the query returned more
+            rows than that, "truncated" is true and "summary" contains the
+            minimum, maximum, and mean of each numeric column over all rows.
+            If the query can't be run, the result contains an "error" instead.
             ''',
         'parameters': {
             'type': 'object',
@@ -59,26 +194,241 @@ database_tool = {
     }
 }
 
+# Tool description for direct-SQL mode
+sql_tool = {
+    'type': 'function',
+    'function': {
+        'name': 'run_sql',
+        'description': '''
+            Runs a SQLite query against the NASDAQ database and returns the
+            results. Use only the tables and columns listed in your
+            instructions.
+
+            Results are returned as JSON containing the column names, up to
+            100 rows, and the total row count. If the query returned more
+            rows than that, "truncated" is true and "summary" contains the
+            minimum, maximum, and mean of each numeric column over all rows.
+            If the query can't be run, the result contains an "error" instead.
+            ''',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'sql': {
+                    'type': 'string',
+                    'description': 'A well-formed SQLite query'
+                },
+            },
+            'required': ['sql']
+        }
+    }
+}
+
+# Maximum number of rows plotted by the render_chart tool
+CHART_MAX_ROWS = 5000
+
+# Tool function
+def render_chart(sql, type, x, y, title=None, x_label=None, y_label=None):
+    print(sql) # Show the query in the host window
+    refresh_database()
+
+    spec = {
+        'sql': sql, 'type': type, 'x': x, 'y': y if isinstance(y, list) else [y],
+        'title': title, 'x_label': x_label, 'y_label': y_label
+    }
+
+    try:
+        result = run_query(DATABASE_PATH, sql, CHART_MAX_ROWS)
+        version = get_database_version(DATABASE_PATH)
+        chart_id, rendered = render_chart_image(spec, result, version, IMAGE_CACHE_DIR)
+    except (QueryError, ChartError) as e:
+        print(e)
+        return json.dumps({ 'error': str(e) })
+
+    if rendered:
+        save_chart_spec(chart_id, spec, version)
+        trim_image_cache()
+
+    output = { 'image_id': chart_id, 'row_count': result['row_count'] }
+
+    if result.get('truncated'):
+        output['note'] = f'Only the first {CHART_MAX_ROWS} rows were plotted.'
+
+    return json.dumps(output)
+
+# Tool description
+chart_tool = {
+    'type': 'function',
+    'function': {
+        'name': 'render_chart',
+        'description': '''
+            Renders a chart of the results of a SQLite query against the NASDAQ
+            database and shows it to the user. Use it instead of the code
+            interpreter for line, bar, and scatter charts of values that a
+            query can return directly, such as prices or moving averages over
+            time. The chart is displayed automatically, so don't describe or
+            link to the image. Returns the number of rows plotted, or an
+            "error" if the chart can't be rendered.
+            ''',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'sql': {
+                    'type': 'string',
+                    'description': 'A well-formed SQLite query that returns the values to plot'
+                },
+                'type': {
+                    'type': 'string',
+                    'enum': CHART_TYPES,
+                    'description': 'Type of chart'
+                },
+                'x': {
+                    'type': 'string',
+                    'description': 'Name of the column returned by the query to use for the x axis'
+                },
+                'y': {
+                    'type': 'array',
+                    'items': { 'type': 'string' },
+                    'description': 'Names of the columns returned by the query to plot, one series each'
+                },
+                'title': {
+                    'type': 'string',
+                    'description': 'Title of the chart'
+                },
+                'x_label': {
+                    'type': 'string',
+                    'description': 'Label for the x axis'
+                },
+                'y_label': {
+                    'type': 'string',
+                    'description': 'Label for the y axis'
+                },
+            },
+            'required': ['sql', 'type', 'x', 'y']
+        }
+    }
+}
+
+# Helper function for getting the IDs of the charts rendered by render_chart
+# calls from their outputs
+def get_chart_ids(tool_calls, tool_outputs):
+    chart_ids = []
+
+    for tool_call, tool_output in zip(tool_calls, tool_outputs):
+        if tool_call.function.name == 'render_chart':
+            chart_id = json.loads(tool_output['output']).get('image_id')
+
+            if chart_id is not None:
+                chart_ids.append(chart_id)
+
+    return chart_ids
+
+# Register the tools. Query results are cached by the database layer, which
+# knows when the data changes, so the tools don't cache their outputs.
+register_tool(database_tool, query_database, timeout=120, max_concurrency=8)
+register_tool(sql_tool, run_sql, timeout=QUERY_TIMEOUT + 5, max_concurrency=POOL_SIZE)
+register_tool(chart_tool, render_chart, timeout=QUERY_TIMEOUT + CHART_TIMEOUT, max_concurrency=CHART_WORKERS * 2)
+
+# Helper function for getting the name of the assistant for the current SQL
+# mode. Assistants are looked up by name, and the assistant for direct-SQL
+# mode has different tools and instructions.
+def get_assistant_name(name):
+    return f'{name}-sql' if SQL_MODE == 'sql' else name
+
+# Note added to the description of the query_database tool when the database
+# contains the precomputed aggregates
+aggregates_note = '''
+            Daily returns and 20-, 50-, and 200-day moving averages of closing
+            prices are precomputed in a table named DailyStats, and monthly
+            prices are precomputed in a table named MonthlyPrices.
+            '''
+
+# Helper function for getting the database tool for the current SQL mode. The
+# precomputed aggregates are mentioned only if the database contains them. In
+# direct-SQL mode, they're listed in the schema in the instructions if they
+# exist.
+def get_database_tool():
+    if SQL_MODE == 'sql':
+        return sql_tool
+
+    if not all(table in get_schema(DATABASE_PATH) for table in AGGREGATE_TABLES):
+        return database_tool
+
+    function = dict(database_tool['function'], description=database_tool['function']['description'] + aggregates_note)
+    return { **database_tool, 'function': function }
+
+# Version of the database when the aggregates were last refreshed
+aggregates_version = None
+aggregates_lock = threading.Lock()
+
+# Helper function for refreshing the precomputed aggregates if the database
+# has changed since they were last refreshed, so they include prices that were
+# loaded while the app was running. It's called at startup and before each
+# query, and costs only a stat of the database file when nothing has changed.
+# Failures are printed rather than raised since queries can still use Stocks,
+# and aren't retried until the database changes again.
+def refresh_database():
+    global aggregates_version
+
+    if get_database_version(DATABASE_PATH) == aggregates_version:
+        return
+
+    with aggregates_lock:
+        if get_database_version(DATABASE_PATH) == aggregates_version:
+            return
+
+        start = time.perf_counter()
+
+        try:
+            added = refresh_aggregates(DATABASE_PATH)
+            increment_counter('aggregate_days_added', added)
+        except sqlite3.Error as e:
+            print(f'The aggregates could not be refreshed: {e}')
+            increment_counter('aggregate_refresh_errors')
+
+        aggregates_version = get_database_version(DATABASE_PATH)
+        record_timing('aggregate_refresh', time.perf_counter() - start)
+
+# Helper function for getting the instructions that describe the database to
+# the assistant in direct-SQL mode
+def get_sql_instructions():
+    if SQL_MODE != 'sql':
+        return ''
+
+    schema = get_schema(DATABASE_PATH)
+
+    return f'''
+        To answer questions about the NASDAQ database, write a SQLite query and pass it
+        to the run_sql tool. Query only the tables and columns listed below.
+
+        {format_schema(schema, schema, schema_descriptions)}
+        '''
+
+# Helper function for describing the tables relevant to a question
+def get_relevant_schema(text):
+    schema = get_schema(DATABASE_PATH)
+    tables = link_schema(schema, text, schema_descriptions)
+    return format_schema(schema, tables, schema_descriptions)
+
 # Helper function for generating SQL queries
 def text2sql(text):
+    # Reuse the SQL generated for the same question if the schema hasn't changed
+    sql = get_cached_translation(DATABASE_PATH, text)
+
+    if sql is not None:
+        return sql
+
+    # Include only the tables that are relevant to the question
+    schema = get_relevant_schema(text)
+
     prompt = f'''
         Generate a well-formed SQLite query from the prompt below. Return
         the SQL only. Do not include a description or markdown characters.
 
         PROMPT: {text}
 
-        The database has a table named Stocks that is defined as follows:
-
-        CREATE TABLE Stocks (
-            ID INTEGER PRIMARY KEY AUTOINCREMENT,
-            Symbol TEXT NOT NULL,   -- Stock symbol (for example, "MSFT")
-            Date DATE NOT NULL,     -- Date
-            Open NUMERIC NOT NULL,  -- Opening price of the stock on that date
-            Low NUMERIC NOT NULL,   -- Lowest price of the stock on that date
-            High NUMERIC NOT NULL,  -- Highest price of the stock on that date
-            Close NUMERIC NOT NULL, -- Closing price of the stock on that date
-            Volume INT NOT NULL     -- Number of shares traded on that date
-        )
+        The database targeted by the query contains the following tables:
+
+        {schema}
         '''
 
     messages = [
@@ -93,22 +443,221 @@ def text2sql(text):
     ]
 
     client = OpenAI()
-    
+    sql = generate_sql(client, messages)
+
+    # Check the SQL locally and ask the model to fix it if it can't be run
+    error = validate_sql(DATABASE_PATH, sql)
+
+    if error is None:
+        increment_counter('text2sql_valid')
+    else:
+        sql, error = repair_sql(client, messages, sql, error)
+
+    # Only cache SQL that can be run
+    if error is None:
+        cache_translation(DATABASE_PATH, text, sql)
+
+    return sql
+
+# Helper function for asking the model for SQL and extracting the SQL from
+# the response, which may contain markdown code fences despite the prompt
+def generate_sql(client, messages):
     response = client.chat.completions.create(
         model='gpt-4o',
         messages=messages
     )
 
     sql = response.choices[0].message.content
+    match = re.search(r'```[\w]*\s*(.*?)```', sql, flags=re.DOTALL)
+
+    if match:
+        sql = match[1]
+
+    return sql.strip().strip('`').strip()
 
-    # Strip markdown characters from the SQL if present
-    pattern = r'^```[\w]*\n|\n```$'
-    return re.sub(pattern, '', sql, flags=re.MULTILINE)
+# Maximum number of times text2sql asks the model to fix SQL that can't be run
+MAX_SQL_REPAIRS = 2
+
+# Helper function for asking the model to fix SQL that failed validation. The
+# exact error is passed back along with the SQL. If a table isn't found, the
+# full schema is included since the table may have been left out of the
+# prompt. Returns the last SQL generated and its error, or None if it's valid.
+def repair_sql(client, messages, sql, error):
+    start = time.perf_counter()
+    messages = list(messages)
+
+    for attempt in range(MAX_SQL_REPAIRS):
+        increment_counter('text2sql_repair_attempts')
+        prompt = f'''
+            The query failed with the following error:
+
+            {error}
+
+            Return a corrected SQLite query. Return the SQL only.
+            '''
+
+        if 'no such table' in error:
+            schema = get_schema(DATABASE_PATH)
+            prompt += f'''
+            The database contains the following tables:
+
+            {format_schema(schema, schema, schema_descriptions)}
+            '''
+
+        messages += [
+            { 'role': 'assistant', 'content': sql },
+            { 'role': 'user', 'content': prompt }
+        ]
+
+        sql = generate_sql(client, messages)
+        error = validate_sql(DATABASE_PATH, sql)
+
+        if error is None:
+            break
+
+    increment_counter('text2sql_repaired' if error is None else 'text2sql_invalid')
+    record_timing('text2sql_repair', time.perf_counter() - start)
+    return sql, error
+
+# Descriptions of the tables and columns in the database. They're included in
+# the schema passed to text2sql and used to pick the tables relevant to each
+# question. Only tables that get_schema finds in the database are described,
+# so the aggregate tables aren't offered until refresh_database creates them.
+schema_descriptions = {
+    'Stocks': 'Daily prices of selected NASDAQ stocks',
+    'Stocks.Symbol': 'Stock symbol (for example, "MSFT")',
+    'Stocks.Open': 'Opening price of the stock on that date',
+    'Stocks.Low': 'Lowest price of the stock on that date',
+    'Stocks.High': 'Highest price of the stock on that date',
+    'Stocks.Close': 'Closing price of the stock on that date',
+    'Stocks.Volume': 'Number of shares traded on that date',
+    'DailyStats': 'Precomputed daily returns and moving averages of closing prices of the stocks in Stocks. Use it instead of computing trends and moving averages from Stocks.',
+    'DailyStats.DailyReturn': 'Change in the closing price since the previous trading day as a fraction (0.01 is 1%)',
+    'DailyStats.MA20': '20-day moving average of the closing price (NULL for the first 19 days)',
+    'DailyStats.MA50': '50-day moving average of the closing price (NULL for the first 49 days)',
+    'DailyStats.MA200': '200-day moving average of the closing price (NULL for the first 199 days)',
+    'MonthlyPrices': 'Precomputed monthly prices and trading volume of the stocks in Stocks',
+    'MonthlyPrices.Month': 'Month in YYYY-MM format (for example, "2024-01")',
+    'MonthlyPrices.Open': 'Opening price of the stock on the first trading day of the month',
+    'MonthlyPrices.High': 'Highest price of the stock during the month',
+    'MonthlyPrices.Low': 'Lowest price of the stock during the month',
+    'MonthlyPrices.Close': 'Closing price of the stock on the last trading day of the month',
+    'MonthlyPrices.Volume': 'Number of shares traded during the month'
+}
 
 # Helper function for executing SQL queries
 def execute_sql(sql):
-    connection = sqlite3.connect('data/nasdaq.db')
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    rows = cursor.fetchall()
-    return rows
+    return run_query(DATABASE_PATH, sql)
+
+# Settings for the on-disk cache of images generated by the code interpreter
+IMAGE_CACHE_DIR = os.path.abspath('image_cache')
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+image_cache_lock = threading.Lock()
+
+# Helper function for validating file IDs before using them in file names
+def is_valid_file_id(file_id):
+    return re.fullmatch(r'[\w-]{1,128}', file_id) is not None
+
+# Helper function for retrieving an image, downloading it only if it isn't cached
+def get_cached_image(client, file_id):
+    path = os.path.join(IMAGE_CACHE_DIR, f'{file_id}.png')
+
+    if os.path.exists(path):
+        os.utime(path) # Mark the image as recently used
+        return path
+
+    # Stream the image into a temporary file and move it into place when
+    # the download is complete so partial downloads never reach the cache
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            with client.files.with_streaming_response.content(file_id) as response:
+                for chunk in response.iter_bytes():
+                    file.write(chunk)
+
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    trim_image_cache()
+    return path
+
+# Helper function for saving the spec of a chart next to its image so the
+# chart can be rendered again if the image goes missing. trim_image_cache
+# evicts the spec together with the image.
+def save_chart_spec(chart_id, spec, version):
+    path = os.path.join(IMAGE_CACHE_DIR, f'{chart_id}.json')
+    fd, temp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump({ 'spec': spec, 'version': version }, file)
+
+    os.replace(temp_path, path)
+
+# Helper function for retrieving a chart rendered by render_chart. If the
+# image is missing but its spec is still saved, it's rendered again, but
+# only if the database hasn't changed since, so a chart ID always refers to
+# the same image. Returns None if the chart can't be retrieved.
+def get_chart_image(chart_id):
+    path = os.path.join(IMAGE_CACHE_DIR, f'{chart_id}.png')
+
+    if os.path.exists(path):
+        os.utime(path) # Mark the image as recently used
+        return path
+
+    try:
+        with open(os.path.join(IMAGE_CACHE_DIR, f'{chart_id}.json'), encoding='utf-8') as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    version = get_database_version(DATABASE_PATH)
+
+    if saved['version'] != list(version):
+        increment_counter('chart_rerenders_stale')
+        return None
+
+    try:
+        result = run_query(DATABASE_PATH, saved['spec']['sql'], CHART_MAX_ROWS)
+        render_chart_image(saved['spec'], result, version, IMAGE_CACHE_DIR)
+    except (QueryError, ChartError) as e:
+        print(e)
+        return None
+
+    increment_counter('chart_rerenders')
+    trim_image_cache()
+    return path
+
+# Helper function for evicting the least recently used images from the cache.
+# The spec of a chart is evicted along with its image so specs don't pile up.
+def trim_image_cache():
+    with image_cache_lock:
+        images = []
+
+        for entry in os.scandir(IMAGE_CACHE_DIR):
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                images.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in images)
+
+        for _, size, path in sorted(images):
+            if total_bytes <= IMAGE_CACHE_MAX_BYTES:
+                break
+
+            for evicted in [path, path[:-len('.png')] + '.json']:
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+
+            total_bytes -= size
+
+# Helper function for formatting a streaming event as a line of JSON
+def format_event(event_type, **data):
+    return json.dumps({ 'type': event_type, **data }) + '\n'
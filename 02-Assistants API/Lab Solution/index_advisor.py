@@ -0,0 +1,273 @@
+# Offline index advisor for the database queried by the query_database tool.
+# Reads the workload log written by database.py, replays the recorded queries
+# against a temporary copy of the database, and tries the indexes suggested by
+# the queries and their plans. Indexes are kept one at a time, starting with
+# the one that saves the most time, and the latency of the workload is reported
+# before and after adding them. Use --apply to add the recommended indexes to
+# the database itself.
+#
+#   python index_advisor.py --database data/nasdaq.db
+#   python index_advisor.py --database data/nasdaq.db --apply
+
+import argparse, json, os, re, sqlite3, statistics, tempfile, time
+from urllib.request import pathname2url
+from database import WORKLOAD_LOG_PATH, canonicalize_sql, get_table_aliases, quote_name
+
+# Helper function for reducing a query to its shape by replacing literals with
+# placeholders, so queries that differ only in their values are grouped
+def get_query_shape(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', canonicalize_sql(sql))
+    return re.sub(r'(?<![\w.])\d+(?:\.\d+)?\b', '?', sql)
+
+# Helper function for reading the distinct queries recorded for a database.
+# Returns a list of (sql, count) tuples with the most frequent queries first.
+# Each query stands for all the queries with the same shape.
+# Queries that failed are skipped, but queries that timed out are kept since
+# they're the ones most likely to benefit from an index. The log that was
+# rotated out by database.py is read too if it exists.
+def load_workload(workload_path, database_path):
+    database_path = os.path.abspath(database_path)
+    queries = {}
+
+    for path in [workload_path + '.1', workload_path]:
+        if not os.path.exists(path):
+            continue
+
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                if entry.get('database') != database_path or entry.get('error') not in (None, 'timeout'):
+                    continue
+
+                key = get_query_shape(entry['sql'])
+                sql, count = queries.get(key, (canonicalize_sql(entry['sql']), 0))
+                queries[key] = (sql, count + 1)
+
+    return sorted(queries.values(), key=lambda query: -query[1])
+
+# Helper function for copying a database to a directory
+def copy_database(path, directory):
+    copy = sqlite3.connect(os.path.join(directory, os.path.basename(path)))
+
+    source = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True)
+    source.backup(copy)
+    source.close()
+
+    return copy
+
+# Helper function for listing the columns of each table in a database
+def get_columns(connection):
+    tables = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+
+    return {
+        table: [row[1] for row in connection.execute(f'PRAGMA table_info({quote_name(table)})')]
+        for (table,) in tables
+    }
+
+# Helper function for getting the plan of a query as a list of strings
+def get_plan(connection, sql):
+    return [row[3] for row in connection.execute(f'EXPLAIN QUERY PLAN {sql}')]
+
+# Helper function for timing a query. The query is run once to warm the cache
+# and then repeat times, and the median time is returned. Queries that run
+# longer than timeout seconds are interrupted and charged the full timeout.
+# Returns None if the query fails.
+def time_query(connection, sql, repeat, timeout):
+    times = []
+
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        deadline = start + timeout
+        connection.set_progress_handler(lambda: time.perf_counter() > deadline, 10000)
+
+        try:
+            connection.execute(sql).fetchall()
+        except sqlite3.Error:
+            return timeout if time.perf_counter() > deadline else None
+        finally:
+            connection.set_progress_handler(None, 10000)
+
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times[1:])
+
+# Helper function for finding the tables in a plan that are scanned in full or
+# searched through an index that doesn't cover the query
+def get_unindexed_tables(plan, aliases):
+    tables = set()
+
+    for detail in plan:
+        match = re.fullmatch(r'(SCAN|SEARCH) (?:TABLE )?(.+?)(?: AS \S+)?(?: USING (.+))?', detail)
+
+        if match is None or match[2].lower() not in aliases:
+            continue
+
+        using = match[3] or ''
+
+        if 'COVERING INDEX' not in using and 'PRIMARY KEY' not in using:
+            tables.add(aliases[match[2].lower()])
+
+    return tables
+
+# Helper function for suggesting indexes for a table used by a query. Columns
+# compared for equality come first, followed by a column compared with a range
+# or, failing that, the columns the query groups or sorts by. Returns the index
+# on those columns and a covering index that adds the table's other columns the
+# query uses.
+def suggest_indexes(sql, table, columns, aliases):
+    text = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    clauses = [match.start() for match in re.finditer(r'\b(?:GROUP|ORDER)\s+BY\b', text, flags=re.IGNORECASE)]
+    equal, ranges, sorted_by, used = [], [], [], []
+
+    for column in columns:
+        pattern = rf'(?<![\w.])(?:(\w+|"[^"]+"|\[[^\]]+\])\s*\.\s*)?[\["]?{re.escape(column)}[\]"]?(?!\w)'
+
+        for match in re.finditer(pattern, text, flags=re.IGNORECASE):
+            qualifier = match[1].strip('"[]').lower() if match[1] else None
+
+            if qualifier is not None and aliases.get(qualifier) != table:
+                continue
+
+            before = text[:match.start()].rstrip()
+            after = text[match.end():].lstrip()
+
+            if column not in used:
+                used.append(column)
+
+            if re.match(r'(?:==?|IN\b|IS\b(?!\s+NOT))', after, flags=re.IGNORECASE) or re.search(r'(?<![<>!])==?$', before):
+                if column not in equal:
+                    equal.append(column)
+            elif re.match(r'(?:[<>]|BETWEEN\b|LIKE\b|GLOB\b)', after, flags=re.IGNORECASE) or re.search(r'[<>]=?$', before):
+                if column not in ranges:
+                    ranges.append(column)
+            elif any(match.start() > clause for clause in clauses):
+                if column not in sorted_by:
+                    sorted_by.append(column)
+
+    key = equal + [column for column in ranges[:1] if column not in equal]
+
+    if len(ranges) == 0:
+        key += [column for column in sorted_by if column not in key]
+
+    if len(key) == 0:
+        return []
+
+    covering = key + [column for column in used if column not in key]
+    return [(table, tuple(key)), (table, tuple(covering))] if covering != key else [(table, tuple(key))]
+
+# Helper function for generating the CREATE INDEX statement for an index
+def get_index_sql(index):
+    table, columns = index
+    name = re.sub(r'\W+', '_', f'idx_{table}_{"_".join(columns)}')
+    return f'CREATE INDEX IF NOT EXISTS {name} ON {quote_name(table)} ({", ".join(quote_name(column) for column in columns)})', name
+
+# Helper function for formatting a duration in milliseconds
+def format_ms(seconds):
+    return 'failed' if seconds is None else f'{seconds * 1000:.1f}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recommend indexes for the queries in the workload log')
+    parser.add_argument('--database', required=True, help='Path of the database the queries were run against')
+    parser.add_argument('--workload', default=WORKLOAD_LOG_PATH, help='Path of the workload log')
+    parser.add_argument('--max-indexes', type=int, default=3, help='Maximum number of indexes to recommend')
+    parser.add_argument('--min-gain', type=float, default=0.05, help='Minimum fraction of the workload time an index must save')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times each query is timed')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Timeout in seconds for each query')
+    parser.add_argument('--apply', action='store_true', help='Add the recommended indexes to the database')
+    args = parser.parse_args()
+
+    workload = load_workload(args.workload, args.database)
+
+    if len(workload) == 0:
+        raise SystemExit(f'No queries for {args.database} in {args.workload}')
+
+    directory = tempfile.TemporaryDirectory(prefix='index_advisor_')
+    connection = copy_database(args.database, directory.name)
+    columns = get_columns(connection)
+    aliases = { sql: get_table_aliases(sql, columns) for sql, _ in workload }
+
+    # Time the workload as it is
+    before = { sql: time_query(connection, sql, args.repeat, args.timeout) for sql, _ in workload }
+    workload = [(sql, count) for sql, count in workload if before[sql] is not None]
+    current = dict(before)
+    total = sum(current[sql] * count for sql, count in workload)
+
+    # Collect candidate indexes for the tables the plans don't use indexes for
+    candidates = []
+
+    for sql, _ in workload:
+        for table in get_unindexed_tables(get_plan(connection, sql), aliases[sql]):
+            for index in suggest_indexes(sql, table, columns[table], aliases[sql]):
+                if index not in candidates:
+                    candidates.append(index)
+
+    print(f'{len(workload)} distinct queries, {sum(count for _, count in workload)} executions, {len(candidates)} candidate indexes')
+
+    # Add the index that saves the most time until none saves enough
+    recommended = []
+
+    while len(recommended) < args.max_indexes:
+        best = None
+
+        for index in candidates:
+            create, name = get_index_sql(index)
+            connection.execute(create)
+
+            # Only time the queries whose plans use the index
+            times = {
+                sql: time_query(connection, sql, args.repeat, args.timeout)
+                for sql, _ in workload
+                if any(name in detail for detail in get_plan(connection, sql))
+            }
+
+            gain = sum((current[sql] - times[sql]) * count for sql, count in workload if times.get(sql) is not None)
+            connection.execute(f'DROP INDEX {name}')
+
+            if gain > 0 and (best is None or gain > best[1]):
+                best = (index, gain, times)
+
+        if best is None or best[1] < args.min_gain * total:
+            break
+
+        index, gain, times = best
+        connection.execute(get_index_sql(index)[0])
+        candidates.remove(index)
+        recommended.append((index, gain, len(times)))
+        current.update({ sql: seconds for sql, seconds in times.items() if seconds is not None })
+
+    connection.close()
+    directory.cleanup()
+
+    # Report the recommendations and the latency of each query
+    print()
+
+    if len(recommended) == 0:
+        print('No indexes recommended')
+
+    for index, gain, queries in recommended:
+        print(f'{get_index_sql(index)[0]};')
+        print(f'    -- saves {format_ms(gain)} ms across {queries} queries')
+
+    print()
+    print(f'{"Query":<60} {"Count":>6} {"Before (ms)":>12} {"After (ms)":>12}')
+
+    for sql, count in workload:
+        text = ' '.join(sql.split())
+        text = text if len(text) <= 60 else text[:57] + '...'
+        print(f'{text:<60} {count:>6} {format_ms(before[sql]):>12} {format_ms(current[sql]):>12}')
+
+    print(f'{"Total":<60} {"":>6} {format_ms(total):>12} {format_ms(sum(current[sql] * count for sql, count in workload)):>12}')
+
+    if args.apply and len(recommended) > 0:
+        with sqlite3.connect(args.database) as target:
+            for index, _, _ in recommended:
+                target.execute(get_index_sql(index)[0])
+
+        print()
+        print(f'Added {len(recommended)} indexes to {args.database}')
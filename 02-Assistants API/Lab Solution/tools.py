@@ -0,0 +1,238 @@
+import json, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from metrics import increment_counter, record_timing
+
+# Registry of the function tools the assistant can call. Each tool is
+# registered once with its description, which includes the JSON schema of
+# its arguments, and its own policies for caching, timeouts, and concurrency.
+# Calls are dispatched, validated, cached, and timed the same way for every tool.
+TOOL_CACHE_SIZE = 1000
+TOOL_WORKERS = 16
+
+tools = {}
+tool_calls_in_progress = {}
+tool_lock = threading.Lock()
+
+# Tools with timeouts run in tool_executor so callers can stop waiting for
+# them. Tool calls from the same run are dispatched in parallel by
+# call_executor.
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='tool')
+call_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='tool-call')
+
+# Python types that correspond to JSON schema types
+json_types = {
+    'string': str, 'number': (int, float), 'integer': int,
+    'boolean': bool, 'array': list, 'object': dict
+}
+
+# Helper function for registering a tool. definition is the tool description
+# passed to the Assistants API, and function implements the tool and returns a
+# string. If cache_ttl is greater than zero, outputs are cached for that many
+# seconds under a key computed by cache_key from the arguments, or from all the
+# arguments if cache_key is None. Each tool has its own cache, which holds up
+# to cache_size outputs. Outputs that contain an error aren't cached. Calls
+# that take longer than timeout seconds are abandoned, and no more than
+# max_concurrency calls run at once. Returns the definition.
+def register_tool(definition, function, cache_ttl=0, cache_key=None, cache_size=TOOL_CACHE_SIZE, timeout=None, max_concurrency=None):
+    name = definition['function']['name']
+
+    tools[name] = {
+        'name': name,
+        'definition': definition,
+        'function': function,
+        'cache': OrderedDict(),
+        'cache_ttl': cache_ttl,
+        'cache_key': cache_key,
+        'cache_size': cache_size,
+        'timeout': timeout,
+        'semaphore': threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+    }
+
+    return definition
+
+# Helper function for formatting an error as tool output the model can act on
+def format_error(message):
+    return json.dumps({ 'error': message })
+
+# Helper function for determining whether tool output describes an error,
+# which is a JSON object with an "error" key
+def is_error(output):
+    try:
+        parsed = json.loads(output)
+    except (TypeError, ValueError):
+        return False
+
+    return isinstance(parsed, dict) and 'error' in parsed
+
+# Helper function for checking a value against a JSON schema. Returns None if
+# the value is valid or a description of the problem if it isn't.
+def validate_value(name, schema, value):
+    expected = json_types.get(schema.get('type'))
+
+    if expected is not None:
+        # JSON booleans aren't numbers even though Python bools are ints
+        if not isinstance(value, expected) or (isinstance(value, bool) and schema['type'] != 'boolean'):
+            return f'Argument "{name}" must be of type {schema["type"]}.'
+
+    if 'enum' in schema and value not in schema['enum']:
+        return f'Argument "{name}" must be one of {", ".join(json.dumps(option) for option in schema["enum"])}.'
+
+    if schema.get('type') == 'array' and 'items' in schema:
+        for item in value:
+            error = validate_value(f'{name}[]', schema['items'], item)
+
+            if error is not None:
+                return error
+
+    return None
+
+# Helper function for checking a tool's arguments against its parameters
+def validate_arguments(parameters, arguments):
+    if not isinstance(arguments, dict):
+        return 'Arguments must be a JSON object.'
+
+    for name in parameters.get('required', []):
+        if name not in arguments:
+            return f'Missing required argument "{name}".'
+
+    properties = parameters.get('properties', {})
+
+    for name, value in arguments.items():
+        if name not in properties:
+            return f'Unknown argument "{name}".'
+
+        error = validate_value(name, properties[name], value)
+
+        if error is not None:
+            return error
+
+    return None
+
+# Helper function for running a tool while enforcing its concurrency limit and
+# timeout. Exceptions are returned as errors rather than raised.
+def run_tool(tool, arguments):
+    name, timeout, semaphore = tool['name'], tool['timeout'], tool['semaphore']
+
+    if semaphore is not None and not semaphore.acquire(timeout=timeout):
+        increment_counter(f'tool_{name}_busy')
+        return format_error(f'The {name} tool is busy. Try again later.')
+
+    try:
+        if timeout is None:
+            try:
+                return tool['function'](**arguments)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        # Release the semaphore when the call finishes, even if it times out,
+        # so abandoned calls still count against the concurrency limit
+        future = tool_executor.submit(tool['function'], **arguments)
+
+        if semaphore is not None:
+            future.add_done_callback(lambda future: semaphore.release())
+
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            increment_counter(f'tool_{name}_timeouts')
+            return format_error(f'The {name} tool did not respond within {timeout} seconds.')
+
+    except Exception as e:
+        increment_counter(f'tool_{name}_errors')
+        return format_error(f'The {name} tool failed: {e}')
+
+# Helper function for running a tool whose outputs are cached. Concurrent calls
+# with the same key share a single call.
+def run_cached_tool(tool, key, arguments):
+    cache = tool['cache']
+
+    with tool_lock:
+        entry = cache.get(key)
+
+        if entry is not None and entry[0] > time.monotonic():
+            increment_counter(f'tool_{tool["name"]}_cache_hits')
+            cache.move_to_end(key)
+            return entry[1]
+
+        increment_counter(f'tool_{tool["name"]}_cache_misses')
+        pending = tool_calls_in_progress.get(key)
+        leader = pending is None
+
+        if leader:
+            pending = tool_calls_in_progress[key] = { 'done': threading.Event(), 'output': None }
+
+    # Wait for the call that's already in progress
+    if not leader:
+        increment_counter(f'tool_{tool["name"]}_calls_shared')
+        pending['done'].wait()
+        return pending['output']
+
+    try:
+        output = run_tool(tool, arguments)
+
+        if not is_error(output):
+            with tool_lock:
+                cache[key] = (time.monotonic() + tool['cache_ttl'], output)
+                cache.move_to_end(key)
+
+                while len(cache) > tool['cache_size']:
+                    cache.popitem(last=False)
+
+        pending['output'] = output
+        return output
+
+    finally:
+        with tool_lock:
+            del tool_calls_in_progress[key]
+
+        pending['done'].set()
+
+# Helper function for calling a tool by name with arguments in JSON. Returns
+# the tool's output, or an error the model can act on if the tool doesn't
+# exist, the arguments are invalid, or the tool fails.
+def call_tool(name, arguments):
+    start = time.perf_counter()
+    tool = tools.get(name)
+
+    if tool is None:
+        increment_counter('tool_unknown')
+        return format_error(f'There is no tool named "{name}".')
+
+    print(f'Calling {name}()')
+
+    try:
+        arguments = json.loads(arguments or '{}')
+    except ValueError:
+        increment_counter(f'tool_{name}_invalid')
+        return format_error('Arguments must be valid JSON.')
+
+    error = validate_arguments(tool['definition']['function'].get('parameters', {}), arguments)
+
+    if error is not None:
+        increment_counter(f'tool_{name}_invalid')
+        return format_error(error)
+
+    if tool['cache_ttl'] > 0:
+        key = (name, tool['cache_key'](**arguments) if tool['cache_key'] else json.dumps(arguments, sort_keys=True))
+        output = run_cached_tool(tool, key, arguments)
+    else:
+        output = run_tool(tool, arguments)
+
+    increment_counter(f'tool_{name}_calls')
+    record_timing(f'tool_{name}', time.perf_counter() - start)
+    return output
+
+# Helper function for executing the function calls requested by a run. Calls
+# are made in parallel and the outputs are returned in the order requested.
+def call_tools(tool_calls):
+    if len(tool_calls) == 1:
+        outputs = [call_tool(tool_calls[0].function.name, tool_calls[0].function.arguments)]
+    else:
+        outputs = list(call_executor.map(lambda tool_call: call_tool(tool_call.function.name, tool_call.function.arguments), tool_calls))
+
+    return [
+        { 'tool_call_id': tool_call.id, 'output': output }
+        for tool_call, output in zip(tool_calls, outputs)
+    ]
@@ -1,36 +1,38 @@
-import os, base64
-from flask import Flask, render_template, request
-from transformers import pipeline
+import os, time
+from flask import Flask, render_template, request, jsonify
 from PIL import Image
+from helpers import MAX_UPLOAD_SIZE, decode_image, get_thumbnail_uri, is_ready, start_warm_up
+from catalog import MAX_TOP_K, load_catalog, search_catalog
+from batching import embed_image
+from metrics import get_metrics, record_timing
+from result_cache import get_image_hash, get_cached_result, cache_result
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
-# Instantiate the CLIP model
-model = pipeline(
-    model='openai/clip-vit-large-patch14',
-    task='zero-shot-image-classification'
-)
-
-# Define candidate labels
-class_labels = [
-    'Robin', 'Cardinal', 'Blue Jay', 'Bluebird', 'Mourning Dove',
-    'Crow', 'Starling', 'Mockingbird', 'Magpie', 'Junco',
-    'Chickadee', 'Nuthatch', 'Titmouse', 'Sparrow', 'Finch',
-    'Goldfinch', 'Wren', 'Woodpecker', 'Hummingbird', 'Parrot',
-    'Eagle', 'Hawk', 'Heron', 'Buzzard', 'Warbler'
-]
+# Load the candidate labels and compute their text embeddings once rather than
+# on every upload
+catalog = load_catalog()
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
-        # Display the image that was uploaded
-        image = request.files["file"]
-        uri = "data:;base64," + base64.b64encode(image.read()).decode("utf-8")
-        image.seek(0)
+        # Decode the image that was uploaded at about the size the model needs.
+        # Files that aren't images or are damaged, such as truncated JPEGs,
+        # raise OSError.
+        try:
+            start = time.perf_counter()
+            image = decode_image(request.files["file"])
+            record_timing('decode_image', time.perf_counter() - start)
+        except (OSError, Image.DecompressionBombError):
+            return render_template("index.html", image_uri="/static/placeholder.png", label="Unrecognized Image"), 400
+
+        # Display a thumbnail of the image
+        uri = get_thumbnail_uri(image)
 
         # Identify the species
-        species = identify_species(Image.open(image))
+        species = identify_species(image)
 
     else:
         # Display a placeholder image
@@ -39,9 +41,57 @@ def index():
 
     return render_template("index.html", image_uri=uri, label=species)
 
+# REST method for classifying an image. Returns the k most likely species,
+# where k is 5 unless specified in the query string.
+@app.route("/classify", methods=["POST"])
+def classify():
+    k = min(max(request.args.get("k", 5, type=int), 1), MAX_TOP_K)
+
+    try:
+        image = decode_image(request.files["file"])
+    except (OSError, Image.DecompressionBombError):
+        return jsonify({ 'error': 'The file is not a supported image.' }), 400
+
+    results = classify_image(image)[:k]
+    return jsonify({ 'results': [{ 'label': label, 'score': score } for label, score in results] })
+
+# Error handler for uploads larger than MAX_UPLOAD_SIZE
+@app.errorhandler(413)
+def upload_too_large(error):
+    return render_template("index.html", image_uri="/static/placeholder.png", label="Photo Too Large"), 413
+
+# REST method for readiness probes. Returns 503 until the model has been loaded
+# and warmed up in this worker, and starts warming it up if it hasn't started.
+@app.route("/ready", methods=["GET"])
+def ready():
+    if is_ready():
+        return jsonify({ 'ready': True })
+
+    start_warm_up()
+    return jsonify({ 'ready': False }), 503
+
+# REST method for retrieving metrics
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify(get_metrics())
+
+# Function that uses zero-shot image classification to find the MAX_TOP_K
+# species that best match an image. Images that look like ones classified
+# before reuse their results. Others are embedded together with other images
+# uploaded at the same time.
+def classify_image(image):
+    start = time.perf_counter()
+    image_hash = get_image_hash(image)
+    results = get_cached_result(image_hash, catalog['version'])
+
+    if results is None:
+        results = search_catalog(catalog, embed_image(image), MAX_TOP_K)
+        cache_result(image_hash, catalog['version'], results)
+
+    record_timing('classify_image', time.perf_counter() - start)
+    return results
+
 # Function that uses zero-shot image classification to classify a bird image
 def identify_species(image):
-    result = model(image, candidate_labels=class_labels)
-    predicted_class = result[0]['label']
-    score = result[0]['score']
+    predicted_class, score = classify_image(image)[0]
     return f'{predicted_class} ({score:.1%})'
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os, queue, threading, time
+from concurrent.futures import Future
+import torch
+from helpers import preprocess_images, embed_pixels
+from metrics import increment_counter, record_timing
+
+# Settings for batching images. Images uploaded at about the same time are
+# sent through the image encoder together by a single worker thread, which
+# waits up to BATCH_WAIT seconds after the first image for more to arrive.
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 8))
+BATCH_WAIT = float(os.environ.get('BATCH_WAIT', 0.01))
+BATCH_TIMEOUT = 60
+
+batch_queue = None
+batch_worker_pid = None
+batch_lock = threading.Lock()
+
+# Helper function for collecting the next batch from the queue. Blocks until
+# at least one image is available.
+def get_batch(requests):
+    batch = [requests.get()]
+    deadline = time.perf_counter() + BATCH_WAIT
+
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.perf_counter()
+
+        try:
+            batch.append(requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+# Function run by the worker thread. Each batch is embedded with one forward
+# pass, and each request's future receives its image's embedding.
+def run_batches(requests):
+    while True:
+        batch = get_batch(requests)
+        start = time.perf_counter()
+
+        for _, _, queued in batch:
+            record_timing('batch_queue_wait', start - queued)
+
+        try:
+            embeddings = embed_pixels(torch.cat([pixel_values for pixel_values, _, _ in batch]))
+        except Exception as e:
+            increment_counter('batch_errors')
+
+            for _, future, _ in batch:
+                future.set_exception(e)
+
+            continue
+
+        record_timing('batch_inference', time.perf_counter() - start)
+        increment_counter('batches')
+        increment_counter('batch_images', len(batch))
+        increment_counter(f'batch_size_{len(batch)}')
+
+        for (_, future, _), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+# Helper function for getting the queue that feeds the worker thread. The
+# worker is started the first time it's needed in each process, since threads
+# don't survive when a server forks worker processes.
+def get_batch_queue():
+    global batch_queue, batch_worker_pid
+
+    with batch_lock:
+        if batch_worker_pid != os.getpid():
+            batch_queue = queue.Queue()
+            batch_worker_pid = os.getpid()
+            threading.Thread(target=run_batches, args=(batch_queue,), name='batch-worker', daemon=True).start()
+
+        return batch_queue
+
+# Helper function for computing a normalized embedding for an image. The image
+# is preprocessed on the calling thread and embedded with other images waiting
+# at the same time.
+def embed_image(image):
+    future = Future()
+    get_batch_queue().put((preprocess_images([image]), future, time.perf_counter()))
+    return future.result(timeout=BATCH_TIMEOUT)
@@ -0,0 +1,133 @@
+# Compares the image encoder backends on a labelled set of bird photos. For
+# each backend, reports accuracy, the latency of classifying one image at a
+# time, the throughput of classifying batches, and peak memory use. Each
+# backend runs in its own process so their memory use is measured separately.
+# The expected species is taken from each file name, so "house-finch-2.jpg" is
+# expected to be classified as "Finch". Run export_onnx.py first to create the
+# ONNX model.
+#
+#   python benchmark.py --images ../Lab/Birds
+
+import argparse, json, os, re, statistics, subprocess, sys, time
+
+# Helper function for finding the label a file name refers to. Returns None if
+# the name doesn't match any label.
+def get_expected_label(path, labels):
+    name = re.sub(r'-\d+$', '', os.path.splitext(os.path.basename(path))[0]).replace('-', ' ').lower()
+
+    for label in labels:
+        if name == label.lower() or name.endswith(' ' + label.lower()):
+            return label
+
+    return None
+
+# Helper function for reading the peak memory use of this process in MB
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+# Helper function for benchmarking the backend selected by CLIP_BACKEND in
+# this process. Returns the results as a dictionary.
+def run_benchmark(paths, repeat, batch_size):
+    from PIL import Image
+    start = time.perf_counter()
+    from catalog import load_catalog, search_catalog
+    from helpers import CLIP_BACKEND, embed_images
+
+    catalog = load_catalog()
+    images = [Image.open(path).convert('RGB') for path in paths]
+    embed_images(images[:1]) # Load the model and warm up
+    load_time = time.perf_counter() - start
+
+    # Classify one image at a time
+    latencies, predictions = [], []
+
+    for _ in range(repeat):
+        predictions = []
+
+        for image in images:
+            start = time.perf_counter()
+            label, _ = search_catalog(catalog, embed_images([image])[0], 1)[0]
+            latencies.append(time.perf_counter() - start)
+            predictions.append(label)
+
+    # Classify batches of images
+    batch = (images * batch_size)[:batch_size]
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        embed_images(batch)
+
+    throughput = batch_size * repeat / (time.perf_counter() - start)
+    latencies.sort()
+
+    return {
+        'backend': CLIP_BACKEND,
+        'load_seconds': load_time,
+        'predictions': predictions,
+        'latency_p50_ms': statistics.median(latencies) * 1000,
+        'latency_p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        'images_per_second': throughput,
+        'peak_rss_mb': get_peak_rss()
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the accuracy, speed, and memory use of the image encoder backends')
+    parser.add_argument('--images', default='../Lab/Birds', help='Directory of labelled bird photos')
+    parser.add_argument('--backends', nargs='+', default=['torch', 'onnx'], help='Backends to compare')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times each measurement is repeated')
+    parser.add_argument('--batch-size', type=int, default=8, help='Number of images in each batch')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.images, name) for name in os.listdir(args.images)
+        if name.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+
+    # Benchmark a single backend in this process and report to the parent
+    if args.run:
+        print(json.dumps(run_benchmark(paths, args.repeat, args.batch_size)))
+        raise SystemExit
+
+    # Read the labels without loading the model, which only the child processes need
+    from catalog import LABELS_PATH, load_labels
+    labels = load_labels(LABELS_PATH)
+    expected = [get_expected_label(path, labels) for path in paths]
+    results = []
+
+    for backend in args.backends:
+        process = subprocess.run(
+            [sys.executable, __file__, '--run', backend, '--images', args.images,
+             '--repeat', str(args.repeat), '--batch-size', str(args.batch_size)],
+            env={ **os.environ, 'CLIP_BACKEND': backend }, capture_output=True, text=True
+        )
+
+        if process.returncode != 0:
+            raise SystemExit(f'The {backend} backend failed:\n{process.stderr}')
+
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    # Report the results
+    labelled = [i for i, label in enumerate(expected) if label is not None]
+    print(f'{len(paths)} images, {len(labelled)} with a known species')
+    print()
+    print(f'{"Backend":<10} {"Accuracy":>9} {"Load (s)":>9} {"p50 (ms)":>9} {"p95 (ms)":>9} {"Images/s":>9} {"Peak RSS (MB)":>14}')
+
+    for result in results:
+        correct = sum(result['predictions'][i] == expected[i] for i in labelled)
+        accuracy = f'{correct / len(labelled):.1%}' if len(labelled) > 0 else 'n/a'
+        rss = f'{result["peak_rss_mb"]:.0f}' if result['peak_rss_mb'] is not None else 'n/a'
+        print(f'{result["backend"]:<10} {accuracy:>9} {result["load_seconds"]:>9.1f} {result["latency_p50_ms"]:>9.1f} '
+              f'{result["latency_p95_ms"]:>9.1f} {result["images_per_second"]:>9.1f} {rss:>14}')
+
+    # Report the images the backends disagree on
+    for result in results[1:]:
+        for path, first, other in zip(paths, results[0]['predictions'], result['predictions']):
+            if first != other:
+                print(f'{os.path.basename(path)}: {results[0]["backend"]} says {first}, {result["backend"]} says {other}')
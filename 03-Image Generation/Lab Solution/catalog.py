@@ -0,0 +1,96 @@
+import os
+import numpy as np
+
+# Settings for the label catalog. Labels are read from a file and embedded
+# once. Catalogs with at least ANN_MIN_LABELS labels are searched with an
+# approximate nearest-neighbor index if faiss is installed, so the time taken
+# stays about the same as the catalog grows. Smaller catalogs are searched
+# exhaustively.
+LABELS_PATH = os.environ.get('LABELS_PATH', 'labels.txt')
+ANN_MIN_LABELS = int(os.environ.get('ANN_MIN_LABELS', 5000))
+ANN_CANDIDATES = 100
+ANN_NEIGHBORS = 32
+ANN_SEARCH_DEPTH = 128
+MAX_TOP_K = 20
+
+# Helper function for reading labels from a file with one label per line.
+# Blank lines, lines that start with #, and repeated labels are skipped. This
+# module imports helpers, which loads the CLIP processor, only when a catalog
+# is loaded or searched, so labels can be read without loading the model.
+def load_labels(path):
+    labels, seen = [], set()
+
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            label = line.strip()
+
+            if label != '' and not label.startswith('#') and label not in seen:
+                labels.append(label)
+                seen.add(label)
+
+    return labels
+
+# Helper function for building an approximate nearest-neighbor index of label
+# embeddings. The index is an HNSW graph over float16 vectors, so it's about
+# as compact as the embeddings, and it's saved next to the label embeddings so
+# it's built only once for each catalog. Returns None if faiss isn't installed.
+def load_label_index(embeddings, version):
+    try:
+        import faiss
+    except ImportError:
+        print('faiss is not installed, so labels will be searched exhaustively')
+        return None
+
+    path = f'label_index_{version[:16]}.faiss'
+
+    if os.path.exists(path):
+        index = faiss.read_index(path)
+    else:
+        vectors = embeddings.astype(np.float32)
+        index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, ANN_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.add(vectors)
+        faiss.write_index(index, path)
+
+    index.hnsw.efSearch = ANN_SEARCH_DEPTH
+    return index
+
+# Helper function for loading a label catalog. Returns a dictionary with the
+# labels, their embeddings, a version that changes when the labels do, and an
+# index for searching the embeddings, which is None for small catalogs.
+def load_catalog(path=LABELS_PATH):
+    from helpers import load_label_embeddings, get_label_key
+
+    labels = load_labels(path)
+    embeddings = load_label_embeddings(labels)
+    version = get_label_key(labels)
+
+    return {
+        'labels': labels,
+        'embeddings': embeddings,
+        'version': version,
+        'index': load_label_index(embeddings, version) if len(labels) >= ANN_MIN_LABELS else None
+    }
+
+# Helper function for finding the k labels that best match an image embedding.
+# Returns a list of (label, probability) tuples with the best match first.
+# When the catalog has an index, probabilities are computed over the closest
+# ANN_CANDIDATES labels, which hold virtually all of the probability since
+# similarities are scaled by CLIP's large logit scale.
+def search_catalog(catalog, image_embedding, k):
+    from helpers import get_label_similarities, get_probabilities
+
+    if catalog['index'] is not None:
+        similarities, ids = catalog['index'].search(image_embedding[None, :].astype(np.float32), max(k, ANN_CANDIDATES))
+        found = ids[0] >= 0
+        similarities, ids = similarities[0][found], ids[0][found]
+    else:
+        similarities = get_label_similarities(image_embedding, catalog['embeddings'])
+        ids = np.arange(len(similarities))
+
+    probabilities = get_probabilities(similarities)
+    k = min(k, len(probabilities))
+    top = np.argpartition(-probabilities, k - 1)[:k]
+    top = top[np.argsort(-probabilities[top])]
+
+    return [(catalog['labels'][ids[i]], float(probabilities[i])) for i in top]
@@ -0,0 +1,76 @@
+# Exports the CLIP image encoder to ONNX and quantizes its weights to int8 so
+# the app can run it with ONNX Runtime. The exported model takes a batch of
+# preprocessed images and returns their normalized embeddings, exactly like
+# embed_pixels in helpers.py. Set CLIP_BACKEND=onnx to use it.
+#
+#   python export_onnx.py
+#   python benchmark.py
+
+import argparse, os, time
+import numpy as np
+import torch
+from helpers import MODEL_NAME, ONNX_MODEL_PATH, get_model
+
+# Image encoder followed by the projection into the shared embedding space
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values):
+        outputs = self.vision_model(pixel_values=pixel_values)
+        embeddings = self.visual_projection(outputs.pooler_output)
+        return embeddings / embeddings.norm(dim=-1, keepdim=True)
+
+# Helper function for exporting the image encoder to ONNX with a variable
+# batch size
+def export_image_encoder(path, image_size, opset):
+    encoder = ImageEncoder(get_model()).eval()
+    pixel_values = torch.randn(2, 3, image_size, image_size)
+
+    with torch.inference_mode():
+        torch.onnx.export(
+            encoder, (pixel_values,), path,
+            input_names=['pixel_values'], output_names=['embeddings'],
+            dynamic_axes={ 'pixel_values': { 0: 'batch' }, 'embeddings': { 0: 'batch' } },
+            opset_version=opset, dynamo=False
+        )
+
+    return encoder, pixel_values
+
+# Helper function for quantizing the weights of the matrix multiplications in
+# a model to int8. Activations are quantized on the fly, so no calibration
+# images are needed.
+def quantize_model(input_path, output_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(input_path, output_path, op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the CLIP image encoder to a quantized ONNX model')
+    parser.add_argument('--output', default=ONNX_MODEL_PATH, help='Path of the quantized model')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--keep-float', action='store_true', help='Keep the unquantized model next to the quantized one')
+    args = parser.parse_args()
+
+    import onnxruntime
+
+    start = time.perf_counter()
+    float_path = args.output.replace('.int8.onnx', '.onnx') if args.output.endswith('.int8.onnx') else f'{args.output}.float.onnx'
+    image_size = get_model().config.vision_config.image_size
+    encoder, pixel_values = export_image_encoder(float_path, image_size, args.opset)
+    quantize_model(float_path, args.output)
+
+    # Compare the quantized model with PyTorch on the sample batch
+    with torch.inference_mode():
+        expected = encoder(pixel_values).numpy()
+
+    session = onnxruntime.InferenceSession(args.output, providers=['CPUExecutionProvider'])
+    actual = session.run(['embeddings'], { 'pixel_values': pixel_values.numpy() })[0]
+    similarity = np.sum(expected * actual, axis=-1).min()
+
+    if not args.keep_float:
+        os.remove(float_path)
+
+    print(f'Exported {MODEL_NAME} to {args.output} ({os.path.getsize(args.output) / 2**20:.0f} MB) in {time.perf_counter() - start:.1f} seconds')
+    print(f'Lowest cosine similarity to PyTorch embeddings: {similarity:.4f}')
@@ -0,0 +1,43 @@
+# Settings for serving the app with Gunicorn, which reads this file
+# automatically when it's started from this directory:
+#
+#   gunicorn app:app
+#
+# The app and the model are loaded once in the parent process before the
+# workers are forked, so the workers share one copy of the weights and start
+# in well under a second. Each worker runs several threads so uploads that
+# arrive together are embedded in one batch. The CPU cores are divided among
+# the workers so they don't compete for them.
+
+import gc, os
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('THREADS', 8))
+timeout = 120
+preload_app = True
+
+threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+os.environ.setdefault('ONNX_THREADS', str(threads_per_worker))
+
+# Runs in the parent process after the app is loaded. Objects that exist at
+# this point are frozen so garbage collection in the workers doesn't touch
+# them, which would copy the memory pages they live in.
+def when_ready(server):
+    from helpers import preload_model
+    preload_model()
+    gc.freeze()
+
+# Runs in each worker before it accepts requests. If the warmup fails, the
+# worker starts anyway rather than exiting, which would make Gunicorn restart
+# it over and over. /ready reports that it isn't ready and retries the warmup.
+def post_fork(server, worker):
+    import torch
+    from helpers import warm_up
+
+    torch.set_num_threads(threads_per_worker)
+
+    try:
+        warm_up()
+    except Exception:
+        worker.log.exception('Warmup failed')
@@ -0,0 +1,228 @@
+import os, io, json, base64, hashlib, threading
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+from transformers import CLIPModel, CLIPProcessor
+
+# Settings for classifying images with CLIP. Labels are turned into sentences
+# with the same template the zero-shot pipeline uses, so scores are unchanged.
+MODEL_NAME = os.environ.get('CLIP_MODEL', 'openai/clip-vit-large-patch14')
+HYPOTHESIS_TEMPLATE = 'This is a photo of {}.'
+LABEL_CACHE_PATH = 'label_embeddings.npz'
+LABEL_BATCH_SIZE = 256
+SCORE_CHUNK_SIZE = 4096
+
+# Settings for the image encoder. The "torch" backend runs the PyTorch model,
+# and the "onnx" backend runs the int8 ONNX model created by export_onnx.py
+# with ONNX Runtime, which is faster and doesn't need the PyTorch weights.
+CLIP_BACKEND = os.environ.get('CLIP_BACKEND', 'torch')
+ONNX_MODEL_PATH = os.environ.get('ONNX_MODEL', 'clip_image_encoder.int8.onnx')
+ONNX_THREADS = int(os.environ.get('ONNX_THREADS', os.cpu_count()))
+
+# Settings for uploaded images. Images are decoded at about the size the model
+# needs, and the page shows a JPEG thumbnail instead of the original file.
+MAX_UPLOAD_SIZE = 16 * 2**20
+THUMBNAIL_SIZE = 512
+THUMBNAIL_QUALITY = 80
+
+# The CLIP model and the ONNX Runtime session are loaded the first time
+# they're needed. The processor only resizes images and tokenizes text.
+processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+model = None
+onnx_session = None
+model_lock = threading.Lock()
+
+# IDs of the processes in which the image encoder has been warmed up and in
+# which warming it up has started
+warm_pid = None
+warming_pid = None
+warm_lock = threading.Lock()
+
+# Temperature applied to similarities, which is saved with the label embeddings
+logit_scale = None
+
+# Helper function for getting the CLIP model, which is loaded on first use
+def get_model():
+    global model
+
+    with model_lock:
+        if model is None:
+            model = CLIPModel.from_pretrained(MODEL_NAME).eval()
+
+        return model
+
+# Helper function for getting the ONNX Runtime session for the image encoder
+def get_onnx_session():
+    global onnx_session
+
+    with model_lock:
+        if onnx_session is None:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError('The onnx backend requires onnxruntime. Install it with "pip install onnxruntime".')
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = ONNX_THREADS
+            options.inter_op_num_threads = 1
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            onnx_session = onnxruntime.InferenceSession(ONNX_MODEL_PATH, options, providers=['CPUExecutionProvider'])
+
+        return onnx_session
+
+# Helper function for loading the model ahead of time. When a server forks its
+# worker processes after loading the app, the PyTorch weights loaded here are
+# shared by every worker, which only copies the memory pages it writes to.
+# ONNX Runtime sessions don't survive a fork, so each worker creates its own.
+def preload_model():
+    if CLIP_BACKEND == 'torch':
+        get_model()
+
+# Helper function for running an image through the image encoder so the first
+# upload doesn't wait for the model to load and initialize
+def warm_up():
+    global warm_pid
+    embed_images([Image.new('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))])
+    warm_pid = os.getpid()
+
+# Helper function for determining whether the image encoder has been warmed up
+# in this process
+def is_ready():
+    return warm_pid == os.getpid()
+
+# Helper function for warming up the image encoder in a background thread. The
+# warmup is started once per process unless it fails.
+def start_warm_up():
+    global warming_pid
+
+    def run():
+        global warming_pid
+
+        try:
+            warm_up()
+        except Exception as e:
+            print(f'Warmup failed: {e}')
+            warming_pid = None
+
+    with warm_lock:
+        if warming_pid != os.getpid():
+            warming_pid = os.getpid()
+            threading.Thread(target=run, name='warm-up', daemon=True).start()
+
+# Helper function for computing normalized text embeddings for a list of
+# labels. Labels are encoded LABEL_BATCH_SIZE at a time so long lists don't
+# need much memory.
+@torch.inference_mode()
+def embed_labels(labels):
+    model = get_model()
+    batches = []
+
+    for i in range(0, len(labels), LABEL_BATCH_SIZE):
+        inputs = processor.tokenizer(
+            [HYPOTHESIS_TEMPLATE.format(label) for label in labels[i:i + LABEL_BATCH_SIZE]],
+            padding=True, return_tensors='pt'
+        )
+
+        outputs = model.text_model(input_ids=inputs['input_ids'], attention_mask=inputs['attention_mask'])
+        embeddings = model.text_projection(outputs.pooler_output)
+        batches.append((embeddings / embeddings.norm(dim=-1, keepdim=True)).numpy())
+
+    return np.concatenate(batches)
+
+# Helper function for decoding an uploaded image no larger than it needs to be
+# for the model and the thumbnail. JPEGs are decoded at a reduced scale with
+# draft, which skips most of the decoding work, and other formats are reduced
+# by an integer factor right after decoding. The image is rotated the way the
+# camera was held. The image is fully decoded before it's returned, so files
+# that aren't images or are damaged raise OSError here rather than later.
+def decode_image(file):
+    image = Image.open(file)
+    width, height = image.size
+    model_size = processor.image_processor.size.get('shortest_edge', 224)
+    scale = max(model_size / min(width, height), THUMBNAIL_SIZE / max(width, height))
+
+    if scale < 1:
+        if image.draft('RGB', (int(width * scale) + 1, int(height * scale) + 1)) is None:
+            factor = int(1 / scale)
+
+            if factor > 1:
+                image = image.reduce(factor)
+
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+# Helper function for creating a JPEG thumbnail of an image as a data URI
+def get_thumbnail_uri(image):
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format='JPEG', quality=THUMBNAIL_QUALITY)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+# Helper function for resizing, cropping, and normalizing a list of images into
+# a tensor of pixel values for the image encoder
+def preprocess_images(images):
+    inputs = processor.image_processor(images=[image.convert('RGB') for image in images], return_tensors='pt')
+    return inputs['pixel_values']
+
+# Helper function for computing normalized embeddings for a batch of
+# preprocessed images in a single pass through the image encoder
+@torch.inference_mode()
+def embed_pixels(pixel_values):
+    if CLIP_BACKEND == 'onnx':
+        return get_onnx_session().run(['embeddings'], { 'pixel_values': pixel_values.numpy() })[0]
+
+    model = get_model()
+    outputs = model.vision_model(pixel_values=pixel_values)
+    embeddings = model.visual_projection(outputs.pooler_output)
+    embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+    return embeddings.numpy().astype(np.float32)
+
+# Helper function for computing normalized embeddings for a list of images
+def embed_images(images):
+    return embed_pixels(preprocess_images(images))
+
+# Helper function for computing a key that changes whenever the label
+# embeddings would change
+def get_label_key(labels):
+    text = json.dumps({ 'model': MODEL_NAME, 'template': HYPOTHESIS_TEMPLATE, 'labels': labels })
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# Helper function for getting the text embeddings for a list of labels as a
+# float16 matrix, which is half the size of float32 and accurate enough for
+# ranking. The embeddings are saved to a cache file so they're computed only
+# when the model, template, or labels change rather than every time the app
+# starts.
+def load_label_embeddings(labels, path=LABEL_CACHE_PATH):
+    global logit_scale
+    key = get_label_key(labels)
+
+    try:
+        with np.load(path) as cache:
+            if str(cache['key']) == key:
+                logit_scale = float(cache['logit_scale'])
+                return cache['embeddings']
+    except (OSError, KeyError, ValueError):
+        pass
+
+    embeddings = embed_labels(labels).astype(np.float16)
+    logit_scale = get_model().logit_scale.exp().item()
+    np.savez(path, key=key, embeddings=embeddings, logit_scale=logit_scale)
+    return embeddings
+
+# Helper function for computing the similarity of an image embedding to every
+# label embedding. float16 embeddings are converted to float32 a chunk at a
+# time so the multiplication can use BLAS without copying the whole matrix.
+def get_label_similarities(image_embedding, label_embeddings):
+    return np.concatenate([
+        label_embeddings[i:i + SCORE_CHUNK_SIZE].astype(np.float32) @ image_embedding
+        for i in range(0, len(label_embeddings), SCORE_CHUNK_SIZE)
+    ])
+
+# Helper function for converting similarities to probabilities the same way
+# as the zero-shot pipeline
+def get_probabilities(similarities):
+    logits = logit_scale * similarities
+    scores = np.exp(logits - logits.max())
+    return scores / scores.sum()
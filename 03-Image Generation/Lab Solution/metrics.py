@@ -0,0 +1,50 @@
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+# Simple in-process metrics. Counters are plain numbers. Timings keep a count,
+# a total, a maximum, and a histogram for each name.
+metrics_lock = threading.Lock()
+counters = defaultdict(int)
+timings = {}
+
+# Upper bounds in seconds of the histogram buckets. Durations longer than the
+# last bound are counted in an extra bucket.
+HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Helper function for incrementing a counter
+def increment_counter(name, amount=1):
+    with metrics_lock:
+        counters[name] += amount
+
+# Helper function for recording a duration in seconds
+def record_timing(name, seconds):
+    with metrics_lock:
+        timing = timings.setdefault(name, { 'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1) })
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+        timing['buckets'][bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+
+# Helper function for formatting a histogram as a dictionary that maps the
+# upper bound of each bucket to the number of durations in it
+def format_histogram(buckets):
+    labels = [f'<={bound}' for bound in HISTOGRAM_BUCKETS] + [f'>{HISTOGRAM_BUCKETS[-1]}']
+    return { label: count for label, count in zip(labels, buckets) if count > 0 }
+
+# Helper function for retrieving a snapshot of all metrics
+def get_metrics():
+    with metrics_lock:
+        return {
+            'counters': dict(counters),
+            'timings': {
+                name: {
+                    'count': timing['count'],
+                    'total': timing['total'],
+                    'max': timing['max'],
+                    'mean': timing['total'] / timing['count'],
+                    'histogram': format_histogram(timing['buckets'])
+                }
+                for name, timing in timings.items()
+            }
+        }
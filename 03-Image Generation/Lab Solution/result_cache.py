@@ -0,0 +1,80 @@
+import os, threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from metrics import increment_counter
+
+# Settings for caching classification results by what images look like rather
+# than by their bytes, so reposts, re-encodes, and resized copies of a photo
+# skip the model. Images match if their 64-bit difference hashes differ in at
+# most RESULT_CACHE_DISTANCE bits and their average colors are close, since
+# the hash only sees brightness. Set RESULT_CACHE_DISTANCE to -1 to disable.
+RESULT_CACHE_SIZE = 1000
+RESULT_CACHE_DISTANCE = int(os.environ.get('RESULT_CACHE_DISTANCE', 4))
+RESULT_CACHE_COLOR_DISTANCE = 8
+
+result_cache = OrderedDict()
+result_cache_lock = threading.Lock()
+
+# Helper function for computing the perceptual hash of an image. Returns a
+# 64-bit difference hash, whose bits record whether each pixel of an 8x8
+# grayscale thumbnail is brighter than the pixel to its right, and the
+# average color of the image.
+def get_image_hash(image):
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, :-1] > pixels[:, 1:]).flatten()
+    color = tuple(int(value) for value in np.asarray(image.resize((8, 8), Image.Resampling.BOX)).reshape(-1, 3).mean(axis=0))
+    return int(''.join('1' if bit else '0' for bit in bits), 2), color
+
+# Helper function for looking up the result for an image with the given hash.
+# version identifies the labels, so results for other labels aren't returned.
+# Returns None if no cached image is close enough.
+def get_cached_result(image_hash, version):
+    if RESULT_CACHE_DISTANCE < 0:
+        return None
+
+    bits, color = image_hash
+
+    with result_cache_lock:
+        key = (version, bits, color)
+        result = result_cache.get(key)
+
+        if result is not None:
+            increment_counter('result_cache_hits')
+            result_cache.move_to_end(key)
+            return result
+
+        # Look for the closest image that's similar enough
+        best = None
+
+        for cached_key in result_cache:
+            cached_version, cached_bits, cached_color = cached_key
+            distance = (bits ^ cached_bits).bit_count()
+
+            if cached_version == version and distance <= RESULT_CACHE_DISTANCE and \
+                    max(abs(a - b) for a, b in zip(color, cached_color)) <= RESULT_CACHE_COLOR_DISTANCE and \
+                    (best is None or distance < best[0]):
+                best = (distance, cached_key)
+
+        if best is None:
+            increment_counter('result_cache_misses')
+            return None
+
+        increment_counter('result_cache_near_hits')
+        result_cache.move_to_end(best[1])
+        return result_cache[best[1]]
+
+# Helper function for caching the result for an image. The least recently
+# used results are evicted when the cache is full.
+def cache_result(image_hash, version, result):
+    if RESULT_CACHE_DISTANCE < 0:
+        return
+
+    bits, color = image_hash
+
+    with result_cache_lock:
+        result_cache[(version, bits, color)] = result
+        result_cache.move_to_end((version, bits, color))
+
+        while len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)